@@ -0,0 +1,297 @@
+# ASGI front end of the bot, an alternative to the Flask app of main.py for
+# servers such as uvicorn:
+#
+#   uvicorn asgi:app
+#
+# It serves the webhook, the push queue endpoint of the deferred
+# processing, /set_webhook, /deleteprefs, /cleanuppeople and /. The bot
+# handlers and the store are synchronous: they run on a pool of
+# asgi_threads threads, or on the dispatcher workers when
+# dispatcher_workers is set, and the request only awaits their result. The
+# replies are collected while the handlers run and sent to Telegram from
+# the event loop with httpx, so that no thread waits for Telegram; the
+# replies of a chat are still sent in order. With the outbound workers
+# enabled the replies go through them, as in the Flask app. The other
+# routes of main.py (export, import and the migrations) are only served by
+# the Flask app.
+
+import asyncio
+import collections
+import concurrent.futures
+import hmac
+import json
+import logging
+import urllib.parse
+
+import telegram
+
+import main
+import mod_tasks
+
+executor = concurrent.futures.ThreadPoolExecutor(main.ASGI_THREADS)
+
+Request = collections.namedtuple('Request', ['query', 'headers', 'body'])
+
+
+# Client of the Bot API for the event loop; like the outbound workers, it
+# waits for retry_after on 429 and backs off on server and network errors.
+# The errors are logged, the replies are not worth failing the update.
+class TelegramClient:
+	API_URL = 'https://api.telegram.org/bot{token}/{method}'
+
+	def __init__(self, token, max_retries=5, backoff=0.5, timeout=10,
+			transport=None):
+		self.token = token
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.transport = transport
+		self._client = None
+
+	def client(self):
+		if self._client is None:
+			import httpx
+			self._client = httpx.AsyncClient(timeout=self.timeout,
+				transport=self.transport)
+		return self._client
+
+	async def call(self, method, params):
+		import httpx
+
+		url = self.API_URL.format(token=self.token, method=method)
+		params = {k: v for k, v in params.items() if v is not None}
+		for attempt in range(self.max_retries + 1):
+			delay = self.backoff * 2 ** attempt
+			try:
+				resp = await self.client().post(url, json=params)
+			except httpx.HTTPError as e:
+				logging.warning("Cannot call %s: %s", method, e)
+			else:
+				if resp.status_code == 200:
+					return resp.json().get('result')
+				if resp.status_code == 429:
+					try:
+						delay = resp.json()['parameters']['retry_after']
+					except (ValueError, KeyError, TypeError):
+						pass
+				elif resp.status_code < 500:
+					logging.error("Telegram refused %s: %s", method, resp.text)
+					return None
+			if attempt < self.max_retries:
+				await asyncio.sleep(delay)
+		logging.error("Giving up %s after %d attempts", method, attempt + 1)
+		return None
+
+	async def close(self):
+		if self._client is not None:
+			await self._client.aclose()
+			self._client = None
+
+telegram_api = TelegramClient(main.TELEGRAM_TOKEN)
+
+# Last batch of replies of each chat still being sent: the replies of an
+# update are sent after those of the previous updates of the chat
+sending = {}
+
+
+async def run_blocking(fn, *args):
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(executor, fn, *args)
+
+# Run fn(update) on the dispatcher workers, where the updates of a chat run
+# in order, or on the thread pool; no thread waits for the previous
+# updates of the chat
+async def run_handlers(fn, update):
+	if main.chat_executor is None:
+		return await run_blocking(fn, update)
+	chat = update.effective_chat
+	key = chat.id if chat is not None else None
+	return await asyncio.wrap_future(main.chat_executor.submit(key, fn, update))
+
+async def send_replies(chat_id, replies):
+	previous = sending.get(chat_id)
+	task = asyncio.ensure_future(send_after(previous, replies))
+	sending[chat_id] = task
+	try:
+		await task
+	finally:
+		if sending.get(chat_id) is task:
+			del sending[chat_id]
+
+async def send_after(previous, replies):
+	if previous is not None:
+		await asyncio.wait([previous])
+	for reply in replies:
+		await telegram_api.call('sendMessage', reply)
+
+# Process an update, returning the reply to send in the webhook response
+# when webhook_reply is set
+async def process_update(update, webhook_reply):
+	if main.outbound is not None:
+		# the handlers queue the replies on the outbound workers
+		if webhook_reply:
+			return await run_handlers(main.process_update_with_reply, update)
+		await run_handlers(main.dispatch_update, update)
+		return None
+	replies = await run_handlers(main.process_update_collecting, update)
+	if not replies:
+		return None
+	if webhook_reply and len(replies) == 1 and replies[0]['chat_id'] not in sending:
+		return dict(replies[0], method='sendMessage')
+	await send_replies(replies[0]['chat_id'], replies)
+	return None
+
+
+async def webhook_handler(request):
+	try:
+		data = json.loads(request.body.decode('utf-8'))
+	except ValueError:
+		data = None
+	if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+		return 400, 'Bad Request'
+	update_id = data['update_id']
+	# the recording and the claim are independent, and the claim may wait
+	# for the store: they run at the same time
+	pending = [run_blocking(main.claim_update, update_id)]
+	if main.recorder is not None:
+		pending.append(run_blocking(main.recorder.record, data))
+	claimed = (await asyncio.gather(*pending))[0]
+	if not claimed:
+		return 200, 'ok'
+	try:
+		if main.DEFERRED_PROCESSING != 'off':
+			await run_blocking(main.defer_update, data)
+			return 200, 'ok'
+		update = telegram.Update.de_json(data, main.telegrambot)
+		reply = await process_update(update, main.WEBHOOK_REPLY)
+	except Exception:
+		await run_blocking(main.release_update, update_id)
+		raise
+	if reply:
+		return 200, reply
+	return 200, 'ok'
+
+
+# Updates posted back by the push queue in deferred processing mode; the
+# queue retries the requests that fail
+async def process_update_task(request):
+	if main.task_queue is None:
+		return 404, 'Not Found'
+	if mod_tasks.QUEUE_HEADER.lower() not in request.headers:
+		return 403, 'Forbidden'
+	update = telegram.Update.de_json(json.loads(request.body.decode('utf-8')),
+		main.telegrambot)
+	await process_update(update, False)
+	return 200, 'ok'
+
+
+async def set_webhook(request):
+	s = await telegram_api.call('setWebhook',
+		{'url': main.BOT_URL + main.HOOK_ADDRESS})
+	if s:
+		return 200, "webhook setup ok"
+	else:
+		return 200, "webhook setup failed"
+
+
+async def deleteprefs(request):
+	resume = request.query.get('resume') == ['1']
+	# the purge works on what is in the store
+	await run_blocking(main.flush_all_writes)
+	done = await run_blocking(lambda: main.store.purge_expired(resume=resume,
+		time_budget=main.DELETEPREFS_TIME_BUDGET))
+	if done:
+		return 200, 'Expired records deleted.'
+	return 200, 'Expired records partially deleted, call /deleteprefs?resume=1 to continue.'
+
+
+# Same as main.check_cron
+def is_cron(request):
+	if request.headers.get(main.CRON_HEADER.lower()) == 'true':
+		return True
+	token = request.headers.get('x-admin-token', '')
+	return bool(main.ADMIN_TOKEN) and hmac.compare_digest(token, main.ADMIN_TOKEN)
+
+
+async def cleanuppeople(request):
+	if not is_cron(request):
+		return 403, 'Forbidden'
+	done = await run_blocking(lambda: main.store.cleanup(
+		time_budget=main.DELETEPREFS_TIME_BUDGET))
+	if done:
+		return 200, 'Stale records deleted.'
+	return 200, 'Stale records partially deleted.'
+
+
+async def index(request):
+	return 200, '.'
+
+
+ROUTES = {
+	main.HOOK_ADDRESS: (webhook_handler, ('POST',)),
+	main.TASK_ADDRESS: (process_update_task, ('POST',)),
+	'/set_webhook': (set_webhook, ('GET', 'POST')),
+	'/deleteprefs': (deleteprefs, ('GET',)),
+	'/cleanuppeople': (cleanuppeople, ('GET',)),
+	'/': (index, ('GET',)),
+}
+
+
+async def read_body(receive):
+	body = b''
+	while True:
+		message = await receive()
+		body += message.get('body', b'')
+		if not message.get('more_body'):
+			return body
+
+# The body is sent as JSON when it is a dict (a reply in webhook reply
+# mode), as text otherwise
+async def send_response(send, status, body):
+	if isinstance(body, dict):
+		body = json.dumps(body).encode('utf-8')
+		content_type = b'application/json'
+	else:
+		body = body.encode('utf-8')
+		content_type = b'text/html; charset=utf-8'
+	await send({'type': 'http.response.start', 'status': status,
+		'headers': [(b'content-type', content_type),
+			(b'content-length', str(len(body)).encode('ascii'))]})
+	await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+	while True:
+		message = await receive()
+		if message['type'] == 'lifespan.startup':
+			await send({'type': 'lifespan.startup.complete'})
+		elif message['type'] == 'lifespan.shutdown':
+			# the pending writes are flushed at exit by main
+			await telegram_api.close()
+			executor.shutdown(wait=False)
+			await send({'type': 'lifespan.shutdown.complete'})
+			return
+
+
+async def app(scope, receive, send):
+	if scope['type'] == 'lifespan':
+		return await lifespan(receive, send)
+	if scope['type'] != 'http':
+		return
+	route = ROUTES.get(scope['path'])
+	if route is None:
+		return await send_response(send, 404, 'Not Found')
+	handler, methods = route
+	if scope['method'] not in methods:
+		return await send_response(send, 405, 'Method Not Allowed')
+	request = Request(
+		urllib.parse.parse_qs(scope.get('query_string', b'').decode('latin-1')),
+		{name.decode('latin-1').lower(): value.decode('latin-1')
+			for name, value in scope.get('headers', [])},
+		await read_body(receive))
+	try:
+		status, response = await handler(request)
+	except Exception:
+		logging.exception("Error handling %s", scope['path'])
+		status, response = 500, 'Internal Server Error'
+	await send_response(send, status, response)
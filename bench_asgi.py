@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Compare the throughput of the Flask app of main.py and of the ASGI app of
+# asgi.py under concurrent webhook requests. Run it from the project
+# directory, where config.ini is.
+#
+#   python bench_asgi.py [--requests 2000] [--concurrency 100] [--threads 8]
+#                        [--latency 20]
+#
+# Both apps run in this process, with the preferences kept in memory and
+# webhook_reply off, so that every reply is a request to Telegram. Every
+# call to the store and every message sent to Telegram waits --latency
+# milliseconds, as a round trip to the datastore or to Telegram would; the
+# ASGI app sends the messages with httpx, to a transport that answers
+# after the same wait. The Flask app gets --threads threads, as a threaded
+# WSGI server would; the ASGI app handles --concurrency requests at a time
+# on an event loop, with the same number of threads for the bot handlers
+# and the store.
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import json
+import random
+import threading
+import time
+
+COMMANDS = ['/auto', '/posto', '/macchinaobici', '/bici', '/salto', '/status']
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark Flask against ASGI.")
+	parser.add_argument('--requests', type=int, default=2000)
+	parser.add_argument('--concurrency', type=int, default=100,
+		help="requests in flight at the same time")
+	parser.add_argument('--threads', type=int, default=8,
+		help="threads of the Flask server and of the ASGI handlers")
+	parser.add_argument('--latency', type=float, default=20,
+		help="milliseconds of every call to the store and to Telegram")
+	parser.add_argument('--chats', type=int, default=50)
+	return parser.parse_args()
+
+# Store that waits before every call, as a remote one would
+class SlowStore:
+	def __init__(self, store, latency):
+		self.store = store
+		self.latency = latency
+
+	def __getattr__(self, name):
+		attr = getattr(self.store, name)
+		if not callable(attr):
+			return attr
+
+		@functools.wraps(attr)
+		def call(*args, **kwargs):
+			time.sleep(self.latency)
+			return attr(*args, **kwargs)
+		return call
+
+def make_updates(count, chats):
+	rnd = random.Random(0)
+	ids = itertools.count(int(time.time() * 1000))
+	for i in range(count):
+		update_id = next(ids)
+		chat_id = -1 - rnd.randrange(chats)
+		user_id = 1 + rnd.randrange(20)
+		text = rnd.choice(COMMANDS)
+		yield {'update_id': update_id, 'message': {
+			'message_id': update_id, 'date': 0,
+			'chat': {'id': chat_id, 'type': 'group'},
+			'from': {'id': user_id, 'first_name': 'Utente ' + str(user_id),
+				'is_bot': False},
+			'text': text,
+			'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}}
+
+def setup(latency):
+	import telegram
+	import main
+
+	main.store = main.LazyObject(lambda: SlowStore(
+		main.build_store('memory'), latency))
+	main.outbound = None
+	main.recorder = None
+	main.WEBHOOK_REPLY = False
+	bot = main.telegrambot.get()
+	bot.bot = telegram.User(0, 'Autobot', True, username='autobot')
+	bot.send_message = lambda *args, **kwargs: time.sleep(latency)
+	return main
+
+def bench_flask(main, updates, threads):
+	local = threading.local()
+	errors = []
+
+	def post(update):
+		if not hasattr(local, 'client'):
+			local.client = main.app.test_client()
+		if local.client.post(main.HOOK_ADDRESS, json=update).status_code != 200:
+			errors.append(update['update_id'])
+
+	start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+		list(pool.map(post, updates))
+	return time.perf_counter() - start, len(errors)
+
+def bench_asgi(main, updates, concurrency, threads, latency):
+	import httpx
+	import asgi
+
+	async def telegram_api(request):
+		await asyncio.sleep(latency)
+		return httpx.Response(200, json={'ok': True, 'result': True})
+
+	asgi.executor = concurrent.futures.ThreadPoolExecutor(threads)
+	asgi.telegram_api = asgi.TelegramClient(main.TELEGRAM_TOKEN,
+		transport=httpx.MockTransport(telegram_api))
+	errors = []
+
+	async def post(update, semaphore):
+		async with semaphore:
+			body = json.dumps(update).encode('utf-8')
+			scope = {'type': 'http', 'method': 'POST', 'path': main.HOOK_ADDRESS,
+				'query_string': b'', 'headers': []}
+			status = []
+
+			async def receive():
+				return {'type': 'http.request', 'body': body, 'more_body': False}
+
+			async def send(message):
+				if message['type'] == 'http.response.start':
+					status.append(message['status'])
+
+			await asgi.app(scope, receive, send)
+			if status != [200]:
+				errors.append(update['update_id'])
+
+	async def run():
+		semaphore = asyncio.Semaphore(concurrency)
+		await asyncio.gather(*(post(u, semaphore) for u in updates))
+		await asgi.telegram_api.close()
+
+	start = time.perf_counter()
+	asyncio.run(run())
+	return time.perf_counter() - start, len(errors)
+
+def report(name, count, elapsed, errors):
+	print("%-6s %6d requests in %6.2f s  %8.1f requests/s  %d errors" %
+		(name, count, elapsed, count / elapsed, errors))
+
+if __name__ == '__main__':
+	args = parse_args()
+	main = setup(args.latency / 1000)
+	updates = list(make_updates(2 * args.requests, args.chats))
+	report('flask', args.requests,
+		*bench_flask(main, updates[:args.requests], args.threads))
+	report('asgi', args.requests,
+		*bench_asgi(main, updates[args.requests:], args.concurrency, args.threads,
+			args.latency / 1000))
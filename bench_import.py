@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+# Measure how long a new instance takes to import main.py, i.e. the time
+# spent before serving the first request. Every sample runs in a fresh
+# interpreter; run it from the project directory, where config.ini is.
+#
+#   python bench_import.py [samples]
+
+import statistics
+import subprocess
+import sys
+
+CODE = """
+import sys, time
+t = time.perf_counter()
+import main
+elapsed = time.perf_counter() - t
+print(elapsed, ' '.join(m for m in ('pulp', 'mod_milano') if m in sys.modules))
+"""
+
+def sample():
+	out = subprocess.check_output([sys.executable, '-c', CODE],
+		universal_newlines=True)
+	elapsed, _, loaded = out.strip().partition(' ')
+	return float(elapsed), loaded
+
+if __name__ == '__main__':
+	samples = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	results = [sample() for i in range(0, samples)]
+	times = [t * 1000 for t, loaded in results]
+	print("import main: median %.1f ms, min %.1f ms, max %.1f ms (%d samples)" %
+		(statistics.median(times), min(times), max(times), samples))
+	print("heavy modules loaded at import: " + (results[0][1] or "none"))
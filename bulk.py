@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+# Bulk export and import of the chats and of the preferences of their
+# members, as NDJSON: a line with the settings of each chat, followed by a
+# line for each of its members. Run it from the project directory, where
+# config.ini is; the store configured there is used unless --storage is
+# given, so that the chats can be moved between projects or backends.
+#
+#   python bulk.py export [--storage sqlite --sqlite-path carpool.db] > chats.ndjson
+#   python bulk.py import [--storage memory] < chats.ndjson
+
+import argparse
+import sys
+
+import main
+import mod_store
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Export or import the chats as NDJSON.")
+	parser.add_argument('command', choices=['export', 'import'])
+	parser.add_argument('--storage', choices=['datastore', 'memory', 'sqlite'])
+	parser.add_argument('--sqlite-path')
+	parser.add_argument('--page-size', type=int, default=100,
+		help="chats read at a time by the export")
+	parser.add_argument('--batch-size', type=int, default=mod_store.MAX_BATCH,
+		help="records written at a time by the import")
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	store = main.build_store(args.storage, args.sqlite_path)
+	if args.command == 'export':
+		for line in mod_store.export_ndjson(store, args.page_size):
+			sys.stdout.write(line)
+	else:
+		count = mod_store.import_ndjson(store, sys.stdin, args.batch_size)
+		print("Imported %d records." % count, file=sys.stderr)
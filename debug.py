@@ -1,11 +1,9 @@
 import main
+import mod_store
 
-from google.cloud import datastore
-import google.auth.credentials
-import mock
-
-credentials = mock.Mock(spec=google.auth.credentials.Credentials)
-main.dsclient = datastore.Client(credentials=credentials)
+main.store = main.LazyObject(lambda: mod_store.MemoryStore(
+	reset_time=main.RESET_TIME, reset_timezone=main.RESET_TIMEZONE,
+	on_change=main.invalidate_chat))
 
 class UpdateMock:
 	class Message:
@@ -24,18 +22,18 @@ def send_message_mock(
 	disable_web_page_preview=None, disable_notification=False,
 	reply_to_message_id=None, reply_markup=None, timeout=None, **kwargs):
 		print("RETURNED MESSAGE: " + text)
-main.bot.send_message = send_message_mock
+main.telegrambot.send_message = send_message_mock
 
 print("The app is started in debug mode.")
 update = UpdateMock()
-main.start(main.bot, update)
+main.start(main.telegrambot, update)
 
 update.message.from_user.first_name = "hola"
 update.message.from_user.last_name = "macchina"
 update.message.text = "/auto 3"
-main.macchina(main.bot, update)
+main.macchina(main.telegrambot, update)
 
 update.message.text = "/postoguest tizio"
-main.postoguest(main.bot, update)
+main.postoguest(main.telegrambot, update)
 
-main.status(main.bot, update)
+main.status(main.telegrambot, update)
@@ -1,30 +1,35 @@
 #!/usr/bin/env python
 
 # python utility modules
+import atexit
 import configparser
+import collections
+import contextlib
+import hmac
+import logging
 import random
+import threading
 import time
-import math
 
 import sys
 import os
 sys.path.append(os.path.join(os.path.abspath('.'), 'env/lib/site-packages'))
 
-# google cloud services
-from google.cloud import datastore
-import google.auth.exceptions
-from flask import Flask, request
+from flask import Flask, Response, abort, request, jsonify, stream_with_context
+import pytz
 
 # telegram
 import telegram
 from telegram.ext import Dispatcher, CommandHandler, MessageHandler
 from telegram.ext.filters import Filters
 
-# linear programming solver
-import pulp
-
 # additional local modules
-import mod_milano
+# (mod_milano and mod_sender are imported where they are needed, and the
+# PuLP solver only by its allocator, to keep the instance start fast)
+import mod_allocator
+import mod_cache
+import mod_store
+from mod_store import get_names_list, roster_fingerprint, split_roster
 
 # start webpages handler
 app = Flask(__name__)
@@ -35,79 +40,273 @@ config.read('config.ini')
 TELEGRAM_TOKEN = config['DEFAULT']['telegram_token']
 HOOK_ADDRESS = config['DEFAULT']['hook_address']
 BOT_URL = config['DEFAULT']['bot_url']
+ALLOCATOR = config['DEFAULT'].get('allocator', 'dp')
+STATUS_CACHE_SIZE = config['DEFAULT'].getint('status_cache_size', 256)
+ROSTER_CACHE_SIZE = config['DEFAULT'].getint('roster_cache_size', 256)
+ROSTER_CACHE_TTL = config['DEFAULT'].getfloat('roster_cache_ttl', 0)
+WEBHOOK_REPLY = config['DEFAULT'].getboolean('webhook_reply', False)
+OUTBOUND_WORKERS = config['DEFAULT'].getint('outbound_workers', 0)
+RATE_LIMIT_GLOBAL = config['DEFAULT'].getfloat('rate_limit_global', 0)
+RATE_LIMIT_CHAT = config['DEFAULT'].getfloat('rate_limit_chat', 0)
+RATE_LIMIT_CHAT_BURST = config['DEFAULT'].getint('rate_limit_chat_burst', 3)
+DISPATCHER_WORKERS = config['DEFAULT'].getint('dispatcher_workers', 0)
+ASGI_THREADS = config['DEFAULT'].getint('asgi_threads', 32)
+DEDUP_WINDOW = config['DEFAULT'].getfloat('dedup_window', 600)
+DEDUP_SIZE = config['DEFAULT'].getint('dedup_size', 10000)
+DEDUP_STORE = config['DEFAULT'].getboolean('dedup_store', False)
+DEFERRED_PROCESSING = config['DEFAULT'].get('deferred_processing', 'off')
+TASK_QUEUE = config['DEFAULT'].get('task_queue', 'local')
+LIVE_STATUS = config['DEFAULT'].getboolean('live_status', False)
+LIVE_STATUS_DELAY = config['DEFAULT'].getfloat('live_status_delay', 5)
+LIVE_STATUS_CACHE_SIZE = config['DEFAULT'].getint('live_status_cache_size', 1024)
+WRITE_BEHIND_DELAY = config['DEFAULT'].getfloat('write_behind_delay', 0)
+DELETEPREFS_PAGE_SIZE = config['DEFAULT'].getint('deleteprefs_page_size', 100)
+DELETEPREFS_WORKERS = config['DEFAULT'].getint('deleteprefs_workers', 8)
+DELETEPREFS_TIME_BUDGET = config['DEFAULT'].getfloat('deleteprefs_time_budget', 480)
+RESET_MODE = config['DEFAULT'].get('reset_mode', 'delete')
+RESET_TIME = config['DEFAULT'].get('reset_time', '00:00')
+RESET_TIMEZONE = config['DEFAULT'].get('reset_timezone', 'UTC')
+STORAGE = config['DEFAULT'].get('storage', 'datastore')
+SQLITE_PATH = config['DEFAULT'].get('sqlite_path', 'carpool.db')
+ADMIN_TOKEN = config['DEFAULT'].get('admin_token', '')
+RECORD_UPDATES = config['DEFAULT'].get('record_updates', '')
+RECORD_SALT = config['DEFAULT'].get('record_salt', None)
+
+# car allocation solver
+allocator = mod_allocator.get_allocator(ALLOCATOR)
+
+# solved allocations, keyed on (chat id, roster fingerprint)
+status_cache = mod_cache.LRUCache(STATUS_CACHE_SIZE)
+
+# chat rosters read from the store, keyed on (chat id,); writes made by
+# other instances are seen after at most ROSTER_CACHE_TTL seconds
+roster_cache = mod_cache.LRUCache(ROSTER_CACHE_SIZE, ttl=ROSTER_CACHE_TTL)
+
+# ids of the updates received in the last DEDUP_WINDOW seconds, keyed on
+# (update id,), to ignore the retries of Telegram
+seen_updates = mod_cache.LRUCache(DEDUP_SIZE, ttl=DEDUP_WINDOW)
+
+# Object built by factory on first use. The Telegram bot, the dispatcher
+# and the store are created this way, so that a new instance
+# can start serving without waiting for them.
+class LazyObject:
+	def __init__(self, factory):
+		self._factory = factory
+		self._obj = None
+		self._lock = threading.Lock()
+
+	def get(self):
+		if self._obj is None:
+			with self._lock:
+				if self._obj is None:
+					self._obj = self._factory()
+		return self._obj
+
+	def __getattr__(self, name):
+		return getattr(self.get(), name)
 
 # Telegram init
-telegrambot = telegram.Bot(token=TELEGRAM_TOKEN)
-dispatcher = Dispatcher(telegrambot, None, workers=0)
-
-# google datastore init
-try:
-	dsclient = datastore.Client()
-except google.auth.exceptions.DefaultCredentialsError as exc:
-	pass
-
-
-##########################
-#  DATASTORE OPERATIONS  #
-##########################
+telegrambot = LazyObject(lambda: telegram.Bot(token=TELEGRAM_TOKEN))
+
+def build_dispatcher():
+	d = Dispatcher(telegrambot, None, workers=0)
+	add_handlers(d)
+	for handlers in d.handlers.values():
+		for handler in handlers:
+			handler.callback = record_errors(handler.callback)
+	return d
+dispatcher = LazyObject(build_dispatcher)
+
+# The dispatcher logs the errors of the handlers instead of raising them;
+# the handlers record them here, so that dispatch_update can raise them and
+# the update is retried. A reply refused by Telegram would be refused
+# again, and is not recorded.
+handler_error = threading.local()
+
+def record_errors(callback):
+	def call(*args, **kwargs):
+		try:
+			return callback(*args, **kwargs)
+		except (telegram.error.BadRequest, telegram.error.Unauthorized):
+			raise
+		except Exception as e:
+			handler_error.error = e
+			raise
+	return call
+
+# Process an update, raising the error of the handler that failed, if any
+def dispatch_update(update):
+	handler_error.error = None
+	try:
+		dispatcher.process_update(update)
+		error = handler_error.error
+	finally:
+		handler_error.error = None
+	if error is not None:
+		raise error
+
+# updates of different chats processed in parallel, if enabled
+chat_executor = None
+if DISPATCHER_WORKERS > 0 or DEFERRED_PROCESSING == 'thread':
+	import mod_executor
+	chat_executor = mod_executor.ChatExecutor(DISPATCHER_WORKERS or 4)
+
+# push queue of the updates processed after the webhook has answered, if
+# enabled
+TASK_ADDRESS = '/tasks/process_update'
+task_queue = None
+if DEFERRED_PROCESSING == 'task':
+	import mod_tasks
+	if TASK_QUEUE == 'local':
+		task_queue = mod_tasks.LocalTaskQueue(app)
+	else:
+		task_queue = mod_tasks.CloudTasksQueue(TASK_QUEUE)
+
+# background delivery of the replies, if enabled; the rate limits need it
+outbound = None
+if OUTBOUND_WORKERS > 0 or RATE_LIMIT_GLOBAL > 0 or RATE_LIMIT_CHAT > 0:
+	import mod_sender
+	outbound = mod_sender.OutboundSender(TELEGRAM_TOKEN,
+		workers=OUTBOUND_WORKERS or 2, global_rate=RATE_LIMIT_GLOBAL,
+		chat_rate=RATE_LIMIT_CHAT, chat_burst=RATE_LIMIT_CHAT_BURST)
+
+# recording of the incoming updates, if enabled
+recorder = None
+if RECORD_UPDATES:
+	import mod_recorder
+	recorder = mod_recorder.UpdateRecorder(RECORD_UPDATES, RECORD_SALT)
+
+# preferences storage
+def build_store(storage=None, sqlite_path=None):
+	storage = storage or STORAGE
+	options = {'reset_time': RESET_TIME, 'reset_timezone': RESET_TIMEZONE,
+		'on_change': chat_changed}
+	if storage == 'memory':
+		return mod_store.MemoryStore(**options)
+	if storage == 'sqlite':
+		return mod_store.SqliteStore(sqlite_path or SQLITE_PATH, **options)
+	return mod_store.DatastoreStore(reset_mode=RESET_MODE,
+		page_size=DELETEPREFS_PAGE_SIZE, workers=DELETEPREFS_WORKERS, **options)
+store = LazyObject(build_store)
+
+
+########################
+#  STORAGE OPERATIONS  #
+########################
+
+# Save preferences to the store
+def put_pref_ds(chat_id, person_id, name, pref, num_seats=5):
+	member = {'id': person_id, 'name': name, 'preference': pref,
+		'seats': num_seats,
+		'timestamp': int(round(time.time()*1000))} # millisecond precision
 
-def get_or_create_chat_entity(chat_id):
-	chat_key = dsclient.key('Chat', chat_id)
-	chat_entity = dsclient.get(chat_key)
-	if not chat_entity:
-		chat_entity = datastore.Entity(key=chat_key)
-		dsclient.put(chat_entity)
-	return chat_entity
+	if WRITE_BEHIND_DELAY > 0:
+		buffer_write(chat_id, person_id, member)
+	else:
+		apply_writes(chat_id, {person_id: member})
 
-# Save preferences to datastore
-def put_pref_ds(chat_id, person_id, name, pref, num_seats=5):
-	get_or_create_chat_entity(chat_id)
-
-	# The Cloud Datastore key for the new entity
-	rec_key = dsclient.key('Chat', chat_id, 'Person', person_id)
-
-	# Prepares the new entity
-	rec = datastore.Entity(key=rec_key)
-	rec['name'] = name
-	rec['preference'] = pref
-	rec['seats'] = num_seats
-	rec['timestamp'] = int(round(time.time()*1000)) # millisecond precision
-
-	# Saves the entity
-	dsclient.put(rec)
-
-# Get car list from datastore
-def get_car_list(chat_id):
-	ancestor = dsclient.key('Chat', chat_id)
-	query = dsclient.query(kind='Person', ancestor=ancestor)
-	query.add_filter('preference', '=', 'CAR')
-	return list(query.fetch())
-
-# Get list of people requiring a lift from datastore
-def get_lifts_list(chat_id):
-	ancestor = dsclient.key('Chat', chat_id)
-	query = dsclient.query(kind='Person', ancestor=ancestor)
-	query.add_filter('preference', '=', 'LIFT')
-	return list(query.fetch())
-
-# Get list of people possibly requiring a lift
-def get_poss_lifts(chat_id):
-	ancestor = dsclient.key('Chat', chat_id)
-	query = dsclient.query(kind='Person', ancestor=ancestor)
-	query.add_filter('preference', '=', 'POSSIBLY_LIFT')
-	return list(query.fetch())
-
-# Get bike list from datastore
-def get_bike_list(chat_id):
-	ancestor = dsclient.key('Chat', chat_id)
-	query = dsclient.query(kind='Person', ancestor=ancestor)
-	query.add_filter('preference', '=', 'BIKE')
-	return list(query.fetch())
-
-# Remove person from datastore
+# Remove person from the store
 def delete_person(chat_id, person_id):
-	rec_key = dsclient.key('Chat', chat_id, 'Person', person_id)
-	dsclient.delete(rec_key)
+	if WRITE_BEHIND_DELAY > 0:
+		buffer_write(chat_id, person_id, None)
+	else:
+		apply_writes(chat_id, {person_id: None})
+
+# Write the changes to the people of a chat; ops maps each person id to the
+# new member, or to None for a deletion
+def apply_writes(chat_id, ops):
+	settings = store.put_preferences(chat_id, ops)
+	invalidate_chat(chat_id)
+	note_live_status(chat_id, settings)
+	schedule_live_status(chat_id)
+
+# Write-behind mode: the changes to a chat are kept in memory for
+# WRITE_BEHIND_DELAY seconds, so that a person changing preference several
+# times in a row costs a single transaction. Pending changes are written
+# before anything reads the chat.
+pending_writes = {}
+flush_timers = {}
+pending_lock = threading.Lock()
+# locks of the chats being flushed, with the number of threads using them
+flush_locks = {}
+
+# Lock held while the pending changes of a chat are written, so that the
+# reads of the chat wait for them; each chat has its own, so that a slow
+# write does not hold up the other chats
+@contextlib.contextmanager
+def flush_lock(chat_id):
+	with pending_lock:
+		entry = flush_locks.setdefault(chat_id, [threading.Lock(), 0])
+		entry[1] += 1
+	try:
+		with entry[0]:
+			yield
+	finally:
+		with pending_lock:
+			entry[1] -= 1
+			if not entry[1]:
+				del flush_locks[chat_id]
+
+def buffer_write(chat_id, person_id, op):
+	with pending_lock:
+		pending_writes.setdefault(chat_id, {})[person_id] = op
+		arm_flush_timer(chat_id)
+	status_cache.evict_chat(chat_id)
+
+# Flush the changes of a chat in WRITE_BEHIND_DELAY seconds, unless a flush
+# is already due; called with pending_lock held
+def arm_flush_timer(chat_id):
+	if chat_id not in flush_timers:
+		timer = threading.Timer(WRITE_BEHIND_DELAY, flush_writes_later, [chat_id])
+		timer.daemon = True
+		flush_timers[chat_id] = timer
+		timer.start()
+
+def take_pending_writes(chat_id):
+	with pending_lock:
+		ops = pending_writes.pop(chat_id, None)
+		timer = flush_timers.pop(chat_id, None)
+	if timer is not None:
+		timer.cancel()
+	return ops
+
+def flush_writes(chat_id):
+	with pending_lock:
+		if chat_id not in pending_writes and chat_id not in flush_locks:
+			return
+	with flush_lock(chat_id):
+		ops = take_pending_writes(chat_id)
+		if not ops:
+			return
+		try:
+			apply_writes(chat_id, ops)
+		except Exception:
+			# keep the changes that have not been superseded meanwhile, and
+			# try again later even if the chat is not used again
+			with pending_lock:
+				ops.update(pending_writes.get(chat_id, {}))
+				pending_writes[chat_id] = ops
+				arm_flush_timer(chat_id)
+			logging.exception("Cannot write the changes of chat %s", chat_id)
+			raise
+
+# Flush run by the timer; the errors have been logged by flush_writes
+def flush_writes_later(chat_id):
+	try:
+		flush_writes(chat_id)
+	except Exception:
+		pass
+
+def flush_all_writes():
+	for chat_id in list(pending_writes):
+		flush_writes(chat_id)
+
+# Drop the pending changes of a chat that is being reset
+def discard_writes(chat_id):
+	with flush_lock(chat_id):
+		take_pending_writes(chat_id)
+
+atexit.register(flush_all_writes)
 
 def get_name(user):
 	user_name = user.first_name
@@ -118,24 +317,119 @@ def get_name(user):
 	return user_name
 
 def delete_records(chat_id):
-	ancestor = dsclient.key('Chat', chat_id)
-	query = dsclient.query(kind='Person', ancestor=ancestor)
-	query.keys_only()
-	records = query.fetch()
-	keys = [r.key for r in records]
-	dsclient.delete_multi(keys)
-
-	chat_entity = get_or_create_chat_entity(chat_id)
-	chat_entity['last_reset'] = math.floor(time.time())
-	dsclient.put(chat_entity)
-
-def get_names_list(l):
-	return [u['name'] for u in l]
+	discard_writes(chat_id)
+	store.reset_chat(chat_id)
+	invalidate_chat(chat_id)
+	schedule_live_status(chat_id)
+
+# Set a setting of the chat
+def set_chat_property(chat_id, name, value):
+	set_chat_properties(chat_id, {name: value})
+
+def set_chat_properties(chat_id, properties):
+	store.set_chat_settings(chat_id, properties)
+	invalidate_chat(chat_id)
+	note_live_status(chat_id, properties)
+
+# Result of the allocation for a roster: cars to use for each seat count,
+# names of the drivers and status message
+StatusResult = collections.namedtuple(
+	'StatusResult', ['num_cars_needed', 'drivers', 'msg'])
+
+# Members of a chat that have not expired, their fingerprint and the time
+# of the last reset, read through the roster cache
+def get_chat_roster(chat_id):
+	summary, settings = get_cached_chat(chat_id)
+
+	members = summary['members']
+	fingerprint = summary['fingerprint']
+	last_reset = settings['last_reset']
+	cutoff = store.last_reset_cutoff(settings)
+	if cutoff is not None:
+		live = mod_store.expire_members(members, cutoff)
+		if len(live) != len(members):
+			members = live
+			roster = split_roster(members)
+			fingerprint = roster_fingerprint(
+				roster['CAR'], roster['LIFT'], roster['POSSIBLY_LIFT'])
+		if last_reset is None or last_reset < cutoff:
+			last_reset = cutoff
+	return members, fingerprint, last_reset
+
+# Versions of the chats, bumped by every invalidation; the key None counts
+# the invalidations of all the chats. A read is only cached if no write
+# happened while the store was being read, otherwise it could put back what
+# the write has just invalidated.
+roster_versions = collections.Counter()
+roster_versions_lock = threading.Lock()
+
+def roster_version(chat_id):
+	with roster_versions_lock:
+		return roster_versions[None], roster_versions[chat_id]
+
+# Summary and settings of a chat, read through the roster cache
+def get_cached_chat(chat_id):
+	flush_writes(chat_id)
+	cached = roster_cache.get((chat_id,))
+	if cached is None:
+		version = roster_version(chat_id)
+		cached = store.fetch_chat(chat_id)
+		with roster_versions_lock:
+			if (roster_versions[None], roster_versions[chat_id]) == version:
+				roster_cache.put((chat_id,), cached)
+		note_live_status(chat_id, cached[1])
+	return cached
+
+# Forget what the caches know about a chat after a write
+def invalidate_chat(chat_id):
+	with roster_versions_lock:
+		roster_versions[chat_id] += 1
+	roster_cache.evict_chat(chat_id)
+	status_cache.evict_chat(chat_id)
+
+# Forget what the caches know about all the chats, e.g. after an import
+def invalidate_all_chats():
+	with roster_versions_lock:
+		roster_versions[None] += 1
+	roster_cache.clear()
+	status_cache.clear()
+
+# A chat changed by the store itself, e.g. by the reset job
+def chat_changed(chat_id):
+	invalidate_chat(chat_id)
+	schedule_live_status(chat_id)
 
 # Helper function to compute a status message
 def compute_status(chat_id):
 
-	cars_list = get_car_list(chat_id)
+	members, fingerprint, last_reset = get_chat_roster(chat_id)
+	roster = split_roster(members)
+	cars_list = roster['CAR']
+	lifts_list = roster['LIFT']
+	poss_lifts_list = roster['POSSIBLY_LIFT']
+	bikes_list = roster['BIKE']
+
+	seed = fingerprint
+	if last_reset is not None:
+		seed = seed ^ last_reset
+
+	# the seed only covers the names, the message also depends on the
+	# order of the lists, on the seats and on the cyclists
+	fingerprint = (seed,
+		tuple((u['name'], u['seats']) for u in cars_list),
+		tuple(get_names_list(lifts_list)),
+		tuple(get_names_list(poss_lifts_list)),
+		tuple(get_names_list(bikes_list)))
+
+	result = status_cache.get((chat_id, fingerprint))
+	if result is None:
+		result = solve_status(
+			cars_list, lifts_list, poss_lifts_list, bikes_list, seed)
+		status_cache.put((chat_id, fingerprint), result)
+	return result.msg
+
+# Allocate the cars for the given roster
+def solve_status(cars_list, lifts_list, poss_lifts_list, bikes_list, seed):
 	num_cars = len(cars_list)
 
 	cars_list_divided = [[] for i in range(0, 10)]
@@ -143,31 +437,16 @@ def compute_status(chat_id):
 		cars_list_divided[car['seats'] - 1].append(car)
 	num_cars_divided = [len(c) for c in cars_list_divided]
 
-	lifts_list = get_lifts_list(chat_id)
 	num_lifts = len(lifts_list)
-
-	poss_lifts_list = get_poss_lifts(chat_id)
 	num_poss_lifts = len(poss_lifts_list)
-
-	bikes_list = get_bike_list(chat_id)
 	num_bikes = len(bikes_list)
 
-	rawseed = str.join(';',
-		['C:'] + sorted(get_names_list(cars_list)) +
-		['L:'] + sorted(get_names_list(lifts_list)) +
-		['P:'] + sorted(get_names_list(poss_lifts_list)))
-	seed = 5381
-	for c in rawseed:
-		seed = ((seed * 33) & 4294967295) ^ ord(c)
-	chat_entity = get_or_create_chat_entity(chat_id)
-	if 'last_reset' in chat_entity:
-		seed = seed ^ chat_entity['last_reset']
-
 	available_seats = sum(
 		[(i + 1) * n for i, n in enumerate(num_cars_divided)])
 
 	if num_bikes + num_cars + num_lifts + num_poss_lifts == 0:
-		return "Non sono stati registrati partecipanti."
+		return StatusResult([0] * 10, [],
+			"Non sono stati registrati partecipanti.")
 
 	if available_seats < num_cars + num_lifts:
 		missing_seats = num_cars + num_lifts - available_seats
@@ -178,6 +457,8 @@ def compute_status(chat_id):
 			msg = "Non ci sono abbastanza auto: rimane una persona a piedi."
 		cyclists = get_names_list(poss_lifts_list) + \
 			get_names_list(bikes_list)
+		num_cars_needed = num_cars_divided
+		drivers = get_names_list(cars_list)
 
 	elif available_seats <= num_cars + num_lifts + num_poss_lifts:
 		num_seats_left = available_seats - num_cars - num_lifts
@@ -202,22 +483,12 @@ def compute_status(chat_id):
 				msg += "."
 		cyclists = [u['name'] for u in poss_lifts_list if u not in passengers] + \
 			get_names_list(bikes_list)
+		num_cars_needed = num_cars_divided
+		drivers = get_names_list(cars_list)
 
 	else:
-		prob = pulp.LpProblem("", pulp.LpMinimize)
-		xvars = []
-		for k in range(1, 11):
-			xvars.append(
-				pulp.LpVariable(chr(ord('a') + k), 0,
-								num_cars_divided[k - 1], pulp.LpInteger))
-		prob += xvars[0] + xvars[1] + xvars[2] + xvars[3] + xvars[4] + \
-			xvars[5] + xvars[6] + xvars[7] + xvars[8] + xvars[9]
-		prob += 1 * xvars[0] + 2 * xvars[1] + 3 * xvars[2] +\
-			4 * xvars[3] + 5 * xvars[4] + 6 * xvars[5] + \
-			7 * xvars[6] + 8 * xvars[7] + 9 * xvars[8] + 10 * \
-			xvars[9] >= num_cars + num_lifts + num_poss_lifts
-		prob.solve()
-		num_cars_needed = [round(v.varValue) for v in prob.variables()]
+		num_cars_needed = allocator.allocate(
+			num_cars_divided, num_cars + num_lifts + num_poss_lifts)
 
 		randstate = random.getstate()
 		random.seed(seed)
@@ -235,6 +506,7 @@ def compute_status(chat_id):
 		msg += (", ".join([u['name'] for u in passengers]))
 		msg += "."
 		cyclists = get_names_list(bikes_list)
+		drivers = get_names_list(chosen_cars)
 
 	if cyclists:
 		if msg:
@@ -243,7 +515,196 @@ def compute_status(chat_id):
 		msg += (", ".join(cyclists))
 		msg += "."
 
-	return msg
+	return StatusResult(num_cars_needed, drivers, msg)
+
+
+#################
+#  BOT REPLIES  #
+#################
+
+# Replies captured while an update is processed in webhook reply mode, or
+# by the ASGI app
+webhook_reply = threading.local()
+
+# Send a message to a chat. In webhook reply mode the first reply to an
+# update is not sent right away: if it is the only one, it is returned by
+# webhook_handler as the body of the HTTP response, which Telegram executes
+# as a method call. Otherwise the message is queued for background
+# delivery when the outbound workers are enabled, or sent synchronously.
+# Confirmations are sent with coalesce=True: when the chat is rate limited,
+# the queued ones are merged into a single message.
+def send_reply(bot, chat_id, text, coalesce=False, **kwargs):
+	kwargs = {k: v for k, v in kwargs.items() if v is not None}
+	pending = getattr(webhook_reply, 'pending', None)
+	if pending is not None and getattr(webhook_reply, 'collect_all', False):
+		pending.append(dict(kwargs, chat_id=chat_id, text=text))
+		return
+	if pending is not None:
+		webhook_reply.pending = None
+		if not pending:
+			webhook_reply.pending = [dict(kwargs, chat_id=chat_id, text=text)]
+			webhook_reply.coalesce = coalesce
+			return
+		# more than one reply: send them all in order
+		send_message(bot, coalesce=webhook_reply.coalesce, **pending.pop())
+	send_message(bot, chat_id=chat_id, text=text, coalesce=coalesce, **kwargs)
+
+def send_message(bot, coalesce=False, **kwargs):
+	if outbound is not None:
+		outbound.send_message(coalesce=coalesce, **kwargs)
+	else:
+		bot.send_message(**kwargs)
+
+def edit_message(bot, chat_id, message_id, text):
+	params = {'chat_id': chat_id, 'message_id': message_id, 'text': text}
+	if outbound is not None:
+		outbound.enqueue('editMessageText', params)
+	else:
+		bot.edit_message_text(**params)
+
+# Live status: in the chats that enable it, the bot keeps a pinned message
+# with the status, edited LIVE_STATUS_DELAY seconds after a change of the
+# preferences, so that several changes in a row cost a single edit. The id
+# of the message is a setting of the chat; the edit is skipped when the
+# status has not changed since the last one.
+live_status_texts = mod_cache.LRUCache(LIVE_STATUS_CACHE_SIZE)
+live_status_timers = {}
+live_status_lock = threading.Lock()
+
+# Ids of the live status messages, keyed on (chat id,), 0 for the chats
+# without one. They are taken from the settings returned by every write and
+# read of a chat, so that the chats without a live status message cost no
+# further reads; a chat that this instance knows nothing about is not
+# refreshed.
+live_status_ids = mod_cache.LRUCache(LIVE_STATUS_CACHE_SIZE)
+
+def note_live_status(chat_id, settings):
+	if LIVE_STATUS and 'status_message_id' in settings:
+		live_status_ids.put((chat_id,), settings['status_message_id'] or 0)
+
+def schedule_live_status(chat_id):
+	if not LIVE_STATUS or not live_status_ids.get((chat_id,)):
+		return
+	with live_status_lock:
+		if chat_id in live_status_timers:
+			return
+		timer = threading.Timer(LIVE_STATUS_DELAY, refresh_live_status, [chat_id])
+		timer.daemon = True
+		live_status_timers[chat_id] = timer
+		timer.start()
+
+def refresh_live_status(chat_id):
+	with live_status_lock:
+		live_status_timers.pop(chat_id, None)
+	try:
+		summary, settings = get_cached_chat(chat_id)
+		message_id = settings.get('status_message_id')
+		if not message_id:
+			return
+		text = compute_status(chat_id)
+		if live_status_texts.get((chat_id,)) == text:
+			return
+		live_status_texts.put((chat_id,), text)
+		edit_message(telegrambot, chat_id, message_id, text)
+	except Exception:
+		logging.exception("Cannot update the status of chat %s", chat_id)
+
+def process_update_with_reply(update):
+	webhook_reply.pending = []
+	try:
+		dispatch_update(update)
+	finally:
+		pending = webhook_reply.pending
+		webhook_reply.pending = None
+	if not pending:
+		return None
+	reply = pending[0]
+	# the reply counts against the rate limits like any other message, and
+	# is queued instead when the chat has to wait
+	if outbound is None or outbound.try_acquire(reply['chat_id']):
+		return dict(reply, method='sendMessage')
+	send_message(telegrambot, coalesce=webhook_reply.coalesce, **reply)
+	return None
+
+# Process an update without sending its replies, which are returned in
+# order; the ASGI app sends them itself, without holding a thread
+def process_update_collecting(update):
+	webhook_reply.pending = []
+	webhook_reply.collect_all = True
+	try:
+		dispatch_update(update)
+	finally:
+		pending = webhook_reply.pending
+		webhook_reply.pending = None
+		webhook_reply.collect_all = False
+	return pending
+
+# Telegram sends an update again when the webhook does not answer in time;
+# returns False for such retries. With DEDUP_STORE the updates are also
+# recorded in the store, to recognise retries reaching another instance.
+def claim_update(update_id):
+	if update_id is None or DEDUP_WINDOW <= 0:
+		return True
+	if not seen_updates.add((update_id,), True):
+		return False
+	if DEDUP_STORE:
+		try:
+			claimed = store.claim_update(update_id, DEDUP_WINDOW)
+		except Exception:
+			# the retry of Telegram must not be taken for a duplicate
+			seen_updates.discard((update_id,))
+			raise
+		if not claimed:
+			return False
+	return True
+
+# Forget an update that could not be processed, so that its retry is
+# processed
+def release_update(update_id):
+	if update_id is None or DEDUP_WINDOW <= 0:
+		return
+	seen_updates.discard((update_id,))
+	if DEDUP_STORE:
+		store.release_update(update_id)
+
+# Deferred processing: the webhook answers as soon as the update has been
+# queued, so that Telegram does not slow down the delivery of the updates
+# while the datastore or the solver are slow. The replies are then always
+# sent with separate requests.
+def defer_update(data):
+	if task_queue is not None:
+		task_queue.push(TASK_ADDRESS, data)
+		return
+	update = telegram.Update.de_json(data, telegrambot)
+	chat = update.effective_chat
+	key = chat.id if chat is not None else None
+	chat_executor.submit(key, process_deferred_update, update)
+
+def process_deferred_update(update):
+	try:
+		dispatcher.process_update(update)
+	except Exception:
+		logging.exception("Cannot process update %s", update.update_id)
+
+# Process an update, returning the reply to send in the webhook response
+# in webhook reply mode. The error of a failed handler is raised, so that
+# the webhook releases the update and answers with an error, and the
+# retry of Telegram is processed.
+def handle_update(update):
+	if WEBHOOK_REPLY:
+		return process_update_with_reply(update)
+	dispatch_update(update)
+	return None
+
+# With the dispatcher workers enabled, the updates run on the worker pool;
+# the updates of a chat run one at a time, in the order they arrived, so
+# that sequential preference changes are applied in order
+def run_update(update):
+	if chat_executor is None:
+		return handle_update(update)
+	chat = update.effective_chat
+	key = chat.id if chat is not None else None
+	return chat_executor.submit(key, handle_update, update).result()
 
 
 #############################
@@ -254,8 +715,38 @@ def compute_status(chat_id):
 def webhook_handler():
 	if request.method == "POST":
 		# retrieve the message in JSON and then transform it to Telegram object
-		update = telegram.Update.de_json(request.get_json(force=True), telegrambot)
-		dispatcher.process_update(update)
+		data = request.get_json(force=True, silent=True)
+		if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+			abort(400)
+		if recorder is not None:
+			recorder.record(data)
+		update_id = data.get('update_id')
+		if not claim_update(update_id):
+			return 'ok'
+		try:
+			if DEFERRED_PROCESSING != 'off':
+				defer_update(data)
+				return 'ok'
+			update = telegram.Update.de_json(data, telegrambot)
+			reply = run_update(update)
+		except Exception:
+			release_update(update_id)
+			raise
+		if reply:
+			return jsonify(reply)
+	return 'ok'
+
+
+# Updates posted back by the push queue in deferred processing mode; the
+# queue retries the requests that fail
+@app.route(TASK_ADDRESS, methods=['POST'])
+def process_update_task():
+	if task_queue is None:
+		abort(404)
+	if mod_tasks.QUEUE_HEADER not in request.headers:
+		abort(403)
+	update = telegram.Update.de_json(request.get_json(force=True), telegrambot)
+	dispatch_update(update)
 	return 'ok'
 
 
@@ -270,12 +761,73 @@ def set_webhook():
 
 @app.route('/deleteprefs')
 def deleteprefs():
-	q = dsclient.query(kind='Chat')
-	res = q.fetch()
-	chats_to_purge = [el.id for el in res if 'persistent' not in el or not el['persistent']]
-	for chat_id in chats_to_purge:
-		delete_records(chat_id)
-	return 'Records deleted.'
+	resume = request.args.get('resume') == '1'
+	# the purge works on what is in the store
+	flush_all_writes()
+	if store.purge_expired(resume=resume, time_budget=DELETEPREFS_TIME_BUDGET):
+		return 'Expired records deleted.'
+	return 'Expired records partially deleted, call /deleteprefs?resume=1 to continue.'
+
+
+@app.route('/cleanuppeople')
+def cleanuppeople():
+	check_cron()
+	if store.cleanup(time_budget=DELETEPREFS_TIME_BUDGET):
+		return 'Stale records deleted.'
+	return 'Stale records partially deleted.'
+
+
+@app.route('/migrate_persistent')
+def migrate_persistent():
+	check_admin()
+	if not isinstance(store.get(), mod_store.DatastoreStore):
+		return 'Nothing to migrate.'
+	updated = store.backfill_persistent()
+	return 'Persistent flag written on ' + str(updated) + ' chats.'
+
+
+@app.route('/rebuildsummaries')
+def rebuildsummaries():
+	check_admin()
+	if not isinstance(store.get(), mod_store.DatastoreStore):
+		return 'Nothing to rebuild.'
+	flush_all_writes()
+	store.rebuild_summaries()
+	return 'Summaries rebuilt.'
+
+
+# The bulk export and import and the maintenance jobs that go through all
+# the chats are only available when admin_token is set, and must be called
+# with the token in the X-Admin-Token header
+def check_admin():
+	token = request.headers.get('X-Admin-Token', '')
+	if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+		abort(403)
+
+# The jobs of cron.yaml that go through all the chats can also be called by
+# App Engine cron, which sets the X-Appengine-Cron header; App Engine
+# removes it from the requests coming from outside
+CRON_HEADER = 'X-Appengine-Cron'
+
+def check_cron():
+	if request.headers.get(CRON_HEADER) != 'true':
+		check_admin()
+
+
+@app.route('/export')
+def export_chats():
+	check_admin()
+	flush_all_writes()
+	lines = mod_store.export_ndjson(store.get(), DELETEPREFS_PAGE_SIZE)
+	return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+@app.route('/import', methods=['POST'])
+def import_chats():
+	check_admin()
+	count = mod_store.import_ndjson(store.get(), request.stream)
+	invalidate_all_chats()
+	return 'Imported ' + str(count) + ' records.'
 
 
 @app.route('/')
@@ -288,8 +840,7 @@ def index():
 ###############################
 
 def start(bot, update):
-	bot.send_message(chat_id=update.message.chat_id,
-					 text="I'm a bot, please talk to me!")
+	send_reply(bot, update.message.chat_id, "I'm a bot, please talk to me!")
 
 
 def sollecita(bot, update):
@@ -314,7 +865,7 @@ def sollecita(bot, update):
 		else:
 			sentence = random.choice(sentences)
 			sentence = sentence.replace("<NAME>", msg)
-		bot.send_message(chat_id=update.message.chat_id, text=sentence)
+		send_reply(bot, update.message.chat_id, sentence)
 
 
 def macchina(bot, update):
@@ -330,7 +881,7 @@ def macchina(bot, update):
 
 	put_pref_ds(chat_id, user.id, user_name, "CAR", num_seats=num_seats)
 	msg = (user_name + " ha la macchina.")
-	bot.send_message(chat_id=chat_id, text=msg)
+	send_reply(bot, chat_id, msg, coalesce=True)
 
 
 def posto(bot, update):
@@ -340,7 +891,7 @@ def posto(bot, update):
 
 	put_pref_ds(chat_id, user.id, user_name, "LIFT")
 	msg = ("A " + user_name + " serve un passaggio.")
-	bot.send_message(chat_id=chat_id, text=msg)
+	send_reply(bot, chat_id, msg, coalesce=True)
 
 
 def postoguest(bot, update):
@@ -353,10 +904,10 @@ def postoguest(bot, update):
 		user_name = msg
 		put_pref_ds(chat_id, user_name, user_name, "LIFT")
 		replyMsg = ("A " + user_name + " serve un passaggio.")
-		bot.send_message(chat_id=chat_id, text=replyMsg)
+		send_reply(bot, chat_id, replyMsg, coalesce=True)
 	else:
 		replyMsg = "Mi serve il nome dell'ospite"
-		bot.send_message(chat_id=chat_id, text=replyMsg)
+		send_reply(bot, chat_id, replyMsg)
 
 
 def pref_posto(bot, update):
@@ -366,7 +917,7 @@ def pref_posto(bot, update):
 
 	put_pref_ds(chat_id, user.id, user_name, "POSSIBLY_LIFT")
 	msg = (user_name + " preferisce avere un passaggio.")
-	bot.send_message(chat_id=chat_id, text=msg)
+	send_reply(bot, chat_id, msg, coalesce=True)
 
 
 def bicicletta(bot, update):
@@ -376,7 +927,7 @@ def bicicletta(bot, update):
 
 	put_pref_ds(chat_id, user.id, user_name, "BIKE")
 	msg = (user_name + " va in bicicletta.")
-	bot.send_message(chat_id=chat_id, text=msg)
+	send_reply(bot, chat_id, msg, coalesce=True)
 
 
 def salto(bot, update):
@@ -386,34 +937,66 @@ def salto(bot, update):
 
 	delete_person(chat_id, user.id)
 	msg = (user_name + " fa l'asociale.")
-	bot.send_message(chat_id=chat_id, text=msg)
+	send_reply(bot, chat_id, msg, coalesce=True)
 
 
 def status(bot, update):
 	chat_id = update.message.chat_id
-	bot.send_message(chat_id=chat_id, text=compute_status(chat_id))
+	send_reply(bot, chat_id, compute_status(chat_id))
 
 
 def reset(bot, update):
 	chat_id = update.message.chat_id
 	delete_records(chat_id)
-	bot.send_message(chat_id=chat_id, text="Preferenze cancellate!")
+	send_reply(bot, chat_id, "Preferenze cancellate!")
 
 
 def enable_reset(bot, update):
 	chat_id = update.message.chat_id
-	chat = get_or_create_chat_entity(chat_id)
-	chat['persistent'] = False
-	dsclient.put(chat)
-	bot.send_message(chat_id=chat_id, text="La cancellazione periodica delle preferenze è stata abilitata.")
+	set_chat_property(chat_id, 'persistent', False)
+	send_reply(bot, chat_id, "La cancellazione periodica delle preferenze è stata abilitata.")
 
 
 def disable_reset(bot, update):
 	chat_id = update.message.chat_id
-	chat = get_or_create_chat_entity(chat_id)
-	chat['persistent'] = True
-	dsclient.put(chat)
-	bot.send_message(chat_id=chat_id, text="La cancellazione periodica delle preferenze è stata disabilitata.")
+	set_chat_property(chat_id, 'persistent', True)
+	send_reply(bot, chat_id, "La cancellazione periodica delle preferenze è stata disabilitata.")
+
+
+def ora_reset(bot, update):
+	chat_id = update.message.chat_id
+	args = update.message.text.strip().split()[1:]
+	try:
+		properties = {'reset_time': '%02d:%02d' % mod_store.parse_reset_time(args[0])}
+		if len(args) > 1:
+			properties['reset_timezone'] = str(pytz.timezone(args[1]))
+	except (IndexError, ValueError, pytz.UnknownTimeZoneError):
+		send_reply(bot, chat_id, "Uso: /orareset HH:MM [fuso orario], ad esempio /orareset 04:00 Europe/Rome")
+		return
+	set_chat_properties(chat_id, properties)
+	send_reply(bot, chat_id, "Le preferenze verranno cancellate ogni giorno alle " + properties['reset_time'] + ".")
+
+
+def status_on(bot, update):
+	chat_id = update.message.chat_id
+	text = compute_status(chat_id)
+	# sent right away, the id of the message is needed
+	message = bot.send_message(chat_id=chat_id, text=text)
+	try:
+		bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id,
+			disable_notification=True)
+	except telegram.error.TelegramError:
+		# the bot is not allowed to pin messages: the status is updated anyway
+		pass
+	set_chat_property(chat_id, 'status_message_id', message.message_id)
+	live_status_texts.put((chat_id,), text)
+
+
+def status_off(bot, update):
+	chat_id = update.message.chat_id
+	set_chat_property(chat_id, 'status_message_id', None)
+	live_status_texts.discard((chat_id,))
+	send_reply(bot, chat_id, "Il messaggio con lo stato non verrà più aggiornato.")
 
 
 def bot_help(bot, update):
@@ -423,26 +1006,18 @@ def bot_help(bot, update):
 	txt += "/bici per indicare che si va in bicicletta.\n"
 	txt += "/salto per rimuoversi dalla lista.\n"
 	txt += "/guest NomeGuest per aggiungere un ospite che vuole andare in macchina.\n"
-	txt += "/reseton e /resetoff per abilitare/disabilitare il reset periodico delle preferenze."
+	txt += "/reseton e /resetoff per abilitare/disabilitare il reset periodico delle preferenze.\n"
+	txt += "/orareset HH:MM [fuso orario] per scegliere l'ora del reset periodico (es. /orareset 04:00 Europe/Rome)."
+	if LIVE_STATUS:
+		txt += "\n/statuson e /statusoff per avere un messaggio fissato con lo stato, aggiornato a ogni modifica."
 
-	bot.send_message(chat_id=update.message.chat_id, text=txt)
+	send_reply(bot, update.message.chat_id, txt)
 
 
 def milano(bot, update):
-	verbs = mod_milano.get_milano()
-	verb = ""
-	while verb == "":
-		verb = random.choice(verbs)
-		if verb[-3:] == "ere":
-			verb = verb[:-3] + "i"
-		elif verb[-3:] == "ire":
-			verb = verb[:-2] + "sci"
-		elif verb[-3:] == "are":
-			verb = verb[:-2]
-		else:
-			verb = ""
-	msg = verb + "milano"
-	bot.send_message(chat_id=update.message.chat_id, text=msg)
+	import mod_milano
+	msg = random.choice(mod_milano.MILANO)
+	send_reply(bot, update.message.chat_id, msg)
 
 
 def murialdo(bot, update):
@@ -458,48 +1033,57 @@ def murialdo(bot, update):
 	           "Davvero? Il tuo QI è circa quello della temperatura ambiente."]
 
 	msg = random.choice(insults)
-	bot.send_message(chat_id=update.message.chat_id, text=msg)
+	send_reply(bot, update.message.chat_id, msg)
 
 
 def unknown(bot, update):
 	#update.message.reply_animation("CgADBAADoq0AAhEdZAfaW_NYik5pqAI")
-	update.message.reply_text("???")
+	reply_to = None
+	if update.message.chat.type != telegram.Chat.PRIVATE:
+		reply_to = update.message.message_id
+	send_reply(bot, update.message.chat_id, "???",
+		reply_to_message_id=reply_to)
 
 
 # Hook commands to command handlers
-dispatcher.add_handler(CommandHandler("start", start))
+def add_handlers(d):
+	d.add_handler(CommandHandler("start", start))
 
-dispatcher.add_handler(CommandHandler("sollecita", sollecita))
+	d.add_handler(CommandHandler("sollecita", sollecita))
 
-dispatcher.add_handler(CommandHandler("macchina", macchina))
-dispatcher.add_handler(CommandHandler("auto", macchina))
+	d.add_handler(CommandHandler("macchina", macchina))
+	d.add_handler(CommandHandler("auto", macchina))
 
-dispatcher.add_handler(CommandHandler("posto", posto))
+	d.add_handler(CommandHandler("posto", posto))
 
-dispatcher.add_handler(CommandHandler("macchinaobici", pref_posto))
-dispatcher.add_handler(CommandHandler("biciomacchina", pref_posto))
-dispatcher.add_handler(CommandHandler("autoobici", pref_posto))
-dispatcher.add_handler(CommandHandler("bicioauto", pref_posto))
+	d.add_handler(CommandHandler("macchinaobici", pref_posto))
+	d.add_handler(CommandHandler("biciomacchina", pref_posto))
+	d.add_handler(CommandHandler("autoobici", pref_posto))
+	d.add_handler(CommandHandler("bicioauto", pref_posto))
 
-dispatcher.add_handler(CommandHandler("bici", bicicletta))
-dispatcher.add_handler(CommandHandler("bicicletta", bicicletta))
+	d.add_handler(CommandHandler("bici", bicicletta))
+	d.add_handler(CommandHandler("bicicletta", bicicletta))
 
-dispatcher.add_handler(CommandHandler("salto", salto))
-dispatcher.add_handler(CommandHandler("pacco", salto))
-dispatcher.add_handler(CommandHandler("icarus", salto))
+	d.add_handler(CommandHandler("salto", salto))
+	d.add_handler(CommandHandler("pacco", salto))
+	d.add_handler(CommandHandler("icarus", salto))
 
-dispatcher.add_handler(CommandHandler("status", status))
+	d.add_handler(CommandHandler("status", status))
+	if LIVE_STATUS:
+		d.add_handler(CommandHandler("statuson", status_on))
+		d.add_handler(CommandHandler("statusoff", status_off))
 
-dispatcher.add_handler(CommandHandler("milano", milano))
+	d.add_handler(CommandHandler("milano", milano))
 
-dispatcher.add_handler(CommandHandler("help", bot_help))
+	d.add_handler(CommandHandler("help", bot_help))
 
-dispatcher.add_handler(CommandHandler("guest", postoguest))
+	d.add_handler(CommandHandler("guest", postoguest))
 
-dispatcher.add_handler(CommandHandler("murialdo", murialdo))
+	d.add_handler(CommandHandler("murialdo", murialdo))
 
-dispatcher.add_handler(CommandHandler("reset", reset))
-dispatcher.add_handler(CommandHandler("reseton", enable_reset))
-dispatcher.add_handler(CommandHandler("resetoff", disable_reset))
+	d.add_handler(CommandHandler("reset", reset))
+	d.add_handler(CommandHandler("reseton", enable_reset))
+	d.add_handler(CommandHandler("resetoff", disable_reset))
+	d.add_handler(CommandHandler("orareset", ora_reset))
 
-dispatcher.add_handler(MessageHandler(Filters.command, unknown))
+	d.add_handler(MessageHandler(Filters.command, unknown))
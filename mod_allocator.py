@@ -0,0 +1,67 @@
+# Car allocation: choose how many cars of each size must be used so that
+# everybody has a seat while using the minimum number of cars.
+#
+# Both allocators take the number of available cars for each seat count
+# (index 0 -> 1 seat, ..., index 9 -> 10 seats) and the number of people
+# needing a seat, and return the number of cars to use for each seat count.
+
+NUM_SEAT_BUCKETS = 10
+
+
+class Allocator:
+	def allocate(self, num_cars_divided, num_people):
+		raise NotImplementedError
+
+
+# Exact bounded-knapsack dynamic programming over the seat buckets.
+# Among the solutions with the minimum number of cars, the one leaving the
+# fewest empty seats is chosen.
+class DPAllocator(Allocator):
+	def allocate(self, num_cars_divided, num_people):
+		# best[seats] = (cars, counts): fewest cars giving exactly `seats`
+		best = {0: (0, ())}
+		for size, available in enumerate(num_cars_divided, 1):
+			step = {}
+			for seats, (cars, counts) in best.items():
+				# a partial solution that already seats everybody is never
+				# improved by adding further cars
+				limit = 0 if seats >= num_people else available
+				for n in range(0, limit + 1):
+					key = seats + n * size
+					if key not in step or cars + n < step[key][0]:
+						step[key] = (cars + n, counts + (n,))
+			best = step
+
+		solutions = [(cars, seats, counts)
+			for seats, (cars, counts) in best.items() if seats >= num_people]
+		if not solutions:
+			raise ValueError("not enough seats for " + str(num_people) + " people")
+		return list(min(solutions)[2])
+
+
+# Reference implementation through the PuLP linear programming solver.
+# It spawns the CBC binary for every solve, so it is only meant to be used
+# for cross-checking the default allocator.
+class PulpAllocator(Allocator):
+	def allocate(self, num_cars_divided, num_people):
+		import pulp
+
+		prob = pulp.LpProblem("", pulp.LpMinimize)
+		xvars = []
+		for k in range(1, NUM_SEAT_BUCKETS + 1):
+			xvars.append(
+				pulp.LpVariable(chr(ord('a') + k), 0,
+								num_cars_divided[k - 1], pulp.LpInteger))
+		prob += pulp.lpSum(xvars)
+		prob += pulp.lpSum([k * x for k, x in enumerate(xvars, 1)]) >= num_people
+		prob.solve(pulp.PULP_CBC_CMD(msg=0))
+		return [round(v.varValue) for v in prob.variables()]
+
+
+ALLOCATORS = {
+	'dp': DPAllocator,
+	'pulp': PulpAllocator,
+}
+
+def get_allocator(name):
+	return ALLOCATORS[name]()
@@ -0,0 +1,72 @@
+# In-process caches shared by the request threads of an instance.
+
+import collections
+import threading
+import time
+
+
+# Bounded least-recently-used cache. Keys are tuples whose first element is
+# the chat id, so that all the entries of a chat can be evicted at once when
+# its preferences change. If ttl is given, entries older than ttl seconds
+# are not returned.
+class LRUCache:
+	def __init__(self, max_entries, ttl=None):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key not in self._entries:
+				return default
+			expires, value = self._entries[key]
+			if expires is not None and expires < time.monotonic():
+				del self._entries[key]
+				return default
+			self._entries.move_to_end(key)
+			return value
+
+	def put(self, key, value):
+		if self.max_entries <= 0 or self.ttl == 0:
+			return
+		with self._lock:
+			self._store(key, value)
+
+	# Store the value only if the key is not cached yet; returns whether it
+	# was stored. Every key is new when the cache is disabled.
+	def add(self, key, value):
+		if self.max_entries <= 0 or self.ttl == 0:
+			return True
+		with self._lock:
+			if key in self._entries:
+				expires, cached = self._entries[key]
+				if expires is None or expires >= time.monotonic():
+					return False
+			self._store(key, value)
+			return True
+
+	def _store(self, key, value):
+		expires = None
+		if self.ttl is not None:
+			expires = time.monotonic() + self.ttl
+		self._entries[key] = (expires, value)
+		self._entries.move_to_end(key)
+		while len(self._entries) > self.max_entries:
+			self._entries.popitem(last=False)
+
+	def discard(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def evict_chat(self, chat_id):
+		with self._lock:
+			for key in [k for k in self._entries if k[0] == chat_id]:
+				del self._entries[key]
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def __len__(self):
+		return len(self._entries)
@@ -0,0 +1,47 @@
+# Thread pool running the updates of different chats in parallel, and the
+# updates of the same chat one at a time, in the order they were submitted.
+
+import collections
+import concurrent.futures
+import threading
+
+
+class ChatExecutor:
+	def __init__(self, workers):
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		# tasks waiting for the running task of their chat to finish; a chat
+		# has an entry only while one of its tasks is running
+		self._queues = {}
+		self._lock = threading.Lock()
+
+	# Run fn(*args) after the tasks already submitted for the same key;
+	# returns a Future with the result
+	def submit(self, key, fn, *args):
+		future = concurrent.futures.Future()
+		with self._lock:
+			queue = self._queues.get(key)
+			if queue is not None:
+				queue.append((future, fn, args))
+				return future
+			self._queues[key] = collections.deque()
+		self.pool.submit(self._run, key, future, fn, args)
+		return future
+
+	def _run(self, key, future, fn, args):
+		if future.set_running_or_notify_cancel():
+			try:
+				future.set_result(fn(*args))
+			except BaseException as e:
+				future.set_exception(e)
+		with self._lock:
+			queue = self._queues[key]
+			if not queue:
+				del self._queues[key]
+				return
+			task = queue.popleft()
+		# the next task of the chat goes to the back of the pool queue, so
+		# that a busy chat does not hold a worker
+		self.pool.submit(self._run, key, *task)
+
+	def shutdown(self, wait=True):
+		self.pool.shutdown(wait=wait)
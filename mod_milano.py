@@ -1,5 +1,5 @@
-def get_milano():
-	return ["abalienare",
+# Italian verbs in the infinitive form
+VERBS = ("abalienare",
 	"abandonare",
 	"abbacchiare",
 	"abbacinare",
@@ -4440,4 +4440,21 @@ def get_milano():
 	"zoccolare",
 	"zompare",
 	"zoppicare",
-	"zufolare"]
+	"zufolare")
+
+# Conjugate a verb to the second person imperative, e.g. "mangia"; None for
+# entries that are not -are/-ere/-ire verbs
+def conjugate(verb):
+	if verb[-3:] == "ere":
+		return verb[:-3] + "i"
+	elif verb[-3:] == "ire":
+		return verb[:-2] + "sci"
+	elif verb[-3:] == "are":
+		return verb[:-2]
+	return None
+
+# All the "...milano" forms, computed once at import
+MILANO = tuple(conjugate(v) + "milano" for v in VERBS if conjugate(v))
+
+def get_milano():
+	return list(VERBS)
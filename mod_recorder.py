@@ -0,0 +1,58 @@
+# Recording of the updates received by the webhook, to replay the traffic
+# later with replay.py.
+#
+# Every update is appended to a JSONL file, together with the time it was
+# received. The ids of users and chats are replaced by pseudonyms (the same
+# id always gets the same pseudonym within a recording) and the names of
+# the users by placeholders, so that recordings can be shared.
+
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+# Properties of the users and chats that are dropped from the recording
+PERSONAL_FIELDS = ('last_name', 'username', 'title', 'language_code')
+
+
+class UpdateRecorder:
+	def __init__(self, path, salt=None):
+		self.path = path
+		if salt is None:
+			salt = os.urandom(16)
+		elif isinstance(salt, str):
+			salt = salt.encode('utf-8')
+		self.salt = salt
+		self._lock = threading.Lock()
+
+	def record(self, data):
+		line = json.dumps({'received': time.time(), 'update': self.anonymize(data)},
+			ensure_ascii=False)
+		with self._lock:
+			with open(self.path, 'a', encoding='utf-8') as f:
+				f.write(line + '\n')
+
+	# Same id in, same pseudonym out; the sign is kept, since Telegram uses
+	# negative ids for group chats
+	def pseudonym(self, value):
+		digest = hmac.new(self.salt, str(abs(value)).encode('ascii'),
+			hashlib.sha256).digest()
+		pseudonym = int.from_bytes(digest[:4], 'big') & 0x7fffffff
+		return -pseudonym if value < 0 else pseudonym
+
+	# Copy of the update with the users and chats anonymized
+	def anonymize(self, data):
+		if isinstance(data, list):
+			return [self.anonymize(v) for v in data]
+		if not isinstance(data, dict):
+			return data
+		data = {k: self.anonymize(v) for k, v in data.items()
+			if k not in PERSONAL_FIELDS}
+		# users have a first name, chats a type
+		if isinstance(data.get('id'), int) and ('first_name' in data or 'type' in data):
+			data['id'] = self.pseudonym(data['id'])
+			if 'first_name' in data:
+				data['first_name'] = 'Utente ' + str(data['id'])
+		return data
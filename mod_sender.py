@@ -0,0 +1,244 @@
+# Outbound messages to Telegram, sent in the background.
+#
+# Handlers enqueue their replies and return immediately; a small pool of
+# worker threads delivers them over a shared keep-alive connection pool,
+# retrying with exponential backoff when Telegram answers 429 or 5xx.
+#
+# The messages of a chat are sent one at a time, in order. Optional token
+# buckets limit the messages sent overall and to each chat, as Telegram
+# does; the messages marked as coalescable that pile up in a chat while
+# its bucket is empty are then sent as a single message.
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+import requests
+import requests.adapters
+
+API_URL = 'https://api.telegram.org/bot{token}/{method}'
+
+logger = logging.getLogger(__name__)
+
+# Chats without messages for which the buckets are kept
+MAX_IDLE_BUCKETS = 10000
+
+
+# Token bucket: rate tokens per second, up to capacity
+class TokenBucket:
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+
+	def refill(self, now):
+		self.tokens = min(self.capacity,
+			self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	# Seconds to wait before a token is available
+	def delay(self, now):
+		self.refill(now)
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+
+	def take(self):
+		self.tokens -= 1
+
+
+class OutboundSender:
+	# global_rate is in messages per second, chat_rate in messages per
+	# minute, chat_burst the messages that a chat can receive at once;
+	# a rate of 0 disables the limit
+	def __init__(self, token, workers=2, max_retries=5, backoff=0.5,
+			timeout=10, global_rate=0, chat_rate=0, chat_burst=3):
+		self.token = token
+		self.workers = workers
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.timeout = timeout
+
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(
+			pool_connections=1, pool_maxsize=workers)
+		self.session.mount('https://', adapter)
+
+		self.global_bucket = None
+		if global_rate > 0:
+			# a bucket holding less than a token would never yield one
+			self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+		self.chat_rate = chat_rate / 60
+		self.chat_burst = max(1, chat_burst)
+		self._chat_buckets = {}
+
+		# chats with messages to send; a chat is in the queue, being sent or
+		# waiting for its bucket while it is in _scheduled
+		self._queue = queue.Queue()
+		self._pending = {}
+		self._scheduled = set()
+		self._unfinished = 0
+		self._done = threading.Condition()
+		self._threads = []
+		self._lock = threading.Lock()
+
+	# Same signature as telegram.Bot.send_message for the parameters we use.
+	# Consecutive messages to a chat sent with coalesce=True may be merged.
+	def send_message(self, chat_id, text, coalesce=False, **kwargs):
+		self.enqueue('sendMessage', dict(kwargs, chat_id=chat_id, text=text),
+			coalesce)
+
+	def enqueue(self, method, params, coalesce=False):
+		self._start()
+		chat_id = params.get('chat_id')
+		with self._done:
+			self._unfinished += 1
+		with self._lock:
+			self._pending.setdefault(chat_id, collections.deque()).append(
+				(method, params, coalesce))
+			if chat_id in self._scheduled:
+				return
+			self._scheduled.add(chat_id)
+		self._queue.put(chat_id)
+
+	# Take a token for a message sent by the caller itself, e.g. in the
+	# response to the webhook; returns False, without taking anything, if the
+	# message has to wait for the limits or for the queued messages of the
+	# chat, in which case the caller should enqueue it instead
+	def try_acquire(self, chat_id):
+		with self._lock:
+			if chat_id in self._scheduled:
+				return False
+			buckets = [b for b in (self.global_bucket, self._chat_bucket(chat_id))
+				if b is not None]
+			now = time.monotonic()
+			if any(b.delay(now) > 0 for b in buckets):
+				return False
+			for bucket in buckets:
+				bucket.take()
+			return True
+
+	# Wait until all the queued messages have been delivered (or dropped)
+	def join(self):
+		with self._done:
+			while self._unfinished:
+				self._done.wait()
+
+	def _start(self):
+		with self._lock:
+			while len(self._threads) < self.workers:
+				t = threading.Thread(target=self._work, daemon=True)
+				t.start()
+				self._threads.append(t)
+
+	def _work(self):
+		while True:
+			chat_id = self._queue.get()
+			with self._lock:
+				batch = self._next_batch(chat_id)
+			if batch is None:
+				continue
+			method, params, count = batch
+			try:
+				self.deliver(method, params)
+			except Exception:
+				logger.exception("Cannot send %s to Telegram", method)
+			finally:
+				self._finished(chat_id, count)
+
+	# The next message of a chat, with the coalescable messages following it
+	# merged in; None if the limits require waiting, in which case the chat
+	# is queued again later
+	def _next_batch(self, chat_id):
+		chat_bucket = self._chat_bucket(chat_id)
+		now = time.monotonic()
+		delay = 0
+		for bucket in (self.global_bucket, chat_bucket):
+			if bucket is not None:
+				delay = max(delay, bucket.delay(now))
+		if delay > 0:
+			timer = threading.Timer(delay, self._queue.put, [chat_id])
+			timer.daemon = True
+			timer.start()
+			return None
+		for bucket in (self.global_bucket, chat_bucket):
+			if bucket is not None:
+				bucket.take()
+
+		pending = self._pending[chat_id]
+		method, params, coalesce = pending.popleft()
+		count = 1
+		# merge only when the next messages would have to wait
+		if coalesce and chat_bucket is not None and chat_bucket.tokens < 1:
+			texts = [params['text']]
+			rest = dict(params, text=None)
+			while pending and pending[0][0] == method and pending[0][2] and \
+					dict(pending[0][1], text=None) == rest:
+				texts.append(pending.popleft()[1]['text'])
+			count = len(texts)
+			params = dict(params, text='\n'.join(texts))
+		return method, params, count
+
+	def _chat_bucket(self, chat_id):
+		if self.chat_rate <= 0 or chat_id is None:
+			return None
+		if chat_id not in self._chat_buckets:
+			if len(self._chat_buckets) > MAX_IDLE_BUCKETS:
+				self._drop_full_buckets()
+			self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+		return self._chat_buckets[chat_id]
+
+	# A full bucket is the same as a new one
+	def _drop_full_buckets(self):
+		now = time.monotonic()
+		for chat_id, bucket in list(self._chat_buckets.items()):
+			bucket.refill(now)
+			if bucket.tokens >= bucket.capacity and chat_id not in self._scheduled:
+				del self._chat_buckets[chat_id]
+
+	def _finished(self, chat_id, count):
+		with self._lock:
+			if self._pending[chat_id]:
+				# back of the queue, after the other chats
+				self._queue.put(chat_id)
+			else:
+				del self._pending[chat_id]
+				self._scheduled.discard(chat_id)
+		with self._done:
+			self._unfinished -= count
+			self._done.notify_all()
+
+	# Call a Telegram API method, retrying on rate limiting and server errors
+	def deliver(self, method, params):
+		url = API_URL.format(token=self.token, method=method)
+		for attempt in range(self.max_retries + 1):
+			delay = self.backoff * 2 ** attempt
+			try:
+				resp = self.session.post(url, json=params, timeout=self.timeout)
+			except requests.RequestException:
+				if attempt == self.max_retries:
+					raise
+				time.sleep(delay)
+				continue
+
+			if resp.status_code == 200:
+				return resp.json().get('result')
+			if resp.status_code == 429:
+				# Telegram tells how long to wait before retrying
+				try:
+					delay = max(delay,
+						resp.json()['parameters']['retry_after'])
+				except (ValueError, KeyError, TypeError):
+					pass
+			elif resp.status_code < 500:
+				logger.error("Telegram refused %s: %s", method, resp.text)
+				return None
+			if attempt < self.max_retries:
+				time.sleep(delay)
+
+		logger.error("Giving up %s after %d attempts", method,
+			self.max_retries + 1)
+		return None
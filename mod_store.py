@@ -0,0 +1,959 @@
+# Storage of the chats and of the preferences of their members.
+#
+# A Store keeps, for every chat, its settings and its members. A member is
+# a dict with the person id, name, preference, seats and the timestamp in
+# milliseconds of the last change. Three implementations are available:
+# DatastoreStore (Google Cloud Datastore, used on App Engine), MemoryStore
+# (for tests and benchmarks) and SqliteStore (for self-hosted instances).
+
+import collections
+import concurrent.futures
+import datetime
+import json
+import math
+import sqlite3
+import threading
+import time
+import uuid
+
+import pytz
+
+PREFERENCES = ['CAR', 'LIFT', 'POSSIBLY_LIFT', 'BIKE']
+
+# Settings of a chat: those that affect how its roster is read, and the
+# message with the live status
+CHAT_SETTINGS = ('persistent', 'last_reset', 'reset_time', 'reset_timezone',
+	'status_message_id')
+
+MAX_BATCH = 500
+
+# Seconds a run of the reset job holds the Job entity without renewing it;
+# the lease is renewed after every page of chats
+JOB_LEASE = 300
+
+# Properties of the Person entities read by the roster queries; the
+# timestamp is needed to expire the preferences at the reset time
+PERSON_PROJECTION = ('name', 'preference', 'seats', 'timestamp')
+
+
+def get_names_list(l):
+	return [u['name'] for u in l]
+
+# Seed of the random choices of a roster, computed from the names
+def roster_fingerprint(cars_list, lifts_list, poss_lifts_list):
+	rawseed = str.join(';',
+		['C:'] + sorted(get_names_list(cars_list)) +
+		['L:'] + sorted(get_names_list(lifts_list)) +
+		['P:'] + sorted(get_names_list(poss_lifts_list)))
+	seed = 5381
+	for c in rawseed:
+		seed = ((seed * 33) & 4294967295) ^ ord(c)
+	return seed
+
+# Split the members of a chat by preference, keeping their order
+def split_roster(members):
+	roster = {pref: [] for pref in PREFERENCES}
+	for m in members:
+		roster[m['preference']].append(m)
+	return roster
+
+# Summary of the members of a chat: the members themselves, sorted as a
+# datastore query would return them (numeric ids first, then names), the
+# counts per preference and per car size, the names and the fingerprint
+def build_chat_summary(members):
+	members = sorted(members,
+		key=lambda m: (isinstance(m['id'], str), m['id']))
+	roster = split_roster(members)
+	car_buckets = [0] * 10
+	for car in roster['CAR']:
+		if 1 <= car['seats'] <= 10:
+			car_buckets[car['seats'] - 1] += 1
+	return {
+		'members': members,
+		'counts': {pref: len(roster[pref]) for pref in PREFERENCES},
+		'car_buckets': car_buckets,
+		'names': {pref: get_names_list(roster[pref]) for pref in PREFERENCES},
+		'fingerprint': roster_fingerprint(
+			roster['CAR'], roster['LIFT'], roster['POSSIBLY_LIFT']),
+	}
+
+def parse_reset_time(value):
+	hours, minutes = value.split(':')
+	hours, minutes = int(hours), int(minutes)
+	if not (0 <= hours < 24 and 0 <= minutes < 60):
+		raise ValueError("invalid reset time: " + value)
+	return hours, minutes
+
+# Preferences expire at the reset time of the chat, without the need for
+# the reset job to run: the members written before the last reset time are
+# ignored when the chat is read. Returns the last reset time in seconds,
+# or None for chats that are never reset.
+def last_reset_cutoff(settings, reset_time, reset_timezone, now=None):
+	if settings.get('persistent'):
+		return None
+	hours, minutes = parse_reset_time(settings.get('reset_time') or reset_time)
+	tz = pytz.timezone(settings.get('reset_timezone') or reset_timezone)
+	if now is None:
+		now = time.time()
+	local_now = datetime.datetime.fromtimestamp(now, tz)
+	day = local_now.date()
+	if (local_now.hour, local_now.minute) < (hours, minutes):
+		day -= datetime.timedelta(days=1)
+	cutoff = tz.localize(datetime.datetime.combine(day,
+		datetime.time(hours, minutes)))
+	return math.floor(cutoff.timestamp())
+
+# Members written after the cutoff; members saved before timestamps were
+# kept in the summary never expire, the reset job removes them
+def expire_members(members, cutoff):
+	return [m for m in members
+		if m.get('timestamp') is None or m['timestamp'] >= cutoff * 1000]
+
+# Bulk export and import. A chat is a 'Chat' record with its settings,
+# followed by a 'Person' record for each of its members; every record is
+# written as a line of JSON (NDJSON).
+
+def chat_record(chat_id, settings):
+	return {'kind': 'Chat', 'id': chat_id,
+		'settings': {k: v for k, v in settings.items() if v is not None}}
+
+def person_record(chat_id, member):
+	return {'kind': 'Person', 'chat': chat_id, 'id': member['id'],
+		'name': member['name'], 'preference': member['preference'],
+		'seats': member['seats'], 'timestamp': member.get('timestamp')}
+
+def record_member(record):
+	return {'id': record['id'], 'name': record['name'],
+		'preference': record['preference'], 'seats': record['seats'],
+		'timestamp': record.get('timestamp')}
+
+def export_ndjson(store, page_size=100):
+	for record in store.export_records(page_size):
+		yield json.dumps(record, ensure_ascii=False) + '\n'
+
+def import_ndjson(store, lines, batch_size=MAX_BATCH):
+	records = (json.loads(line) for line in lines if line.strip())
+	return store.import_records(records, batch_size)
+
+
+class Store:
+	def __init__(self, reset_time='00:00', reset_timezone='UTC', on_change=None):
+		self.reset_time = reset_time
+		self.reset_timezone = reset_timezone
+		# called with the chat id when a chat is changed by the store itself,
+		# e.g. by the reset job, so that callers can drop their caches
+		self.on_change = on_change
+
+	def last_reset_cutoff(self, settings):
+		return last_reset_cutoff(settings, self.reset_time, self.reset_timezone)
+
+	def live_members(self, members, settings):
+		cutoff = self.last_reset_cutoff(settings)
+		if cutoff is None:
+			return members
+		return expire_members(members, cutoff)
+
+	def changed(self, chat_id):
+		if self.on_change is not None:
+			self.on_change(chat_id)
+
+	# Apply changes to the members of a chat: ops maps each person id to the
+	# new member dict, or to None to remove the person. Returns the settings
+	# of the chat, which the implementations read anyway.
+	def put_preferences(self, chat_id, ops):
+		raise NotImplementedError
+
+	# Summary of the members (see build_chat_summary) and settings of a chat
+	def fetch_chat(self, chat_id):
+		raise NotImplementedError
+
+	def set_chat_settings(self, chat_id, settings):
+		raise NotImplementedError
+
+	# Remove all the members of a chat
+	def reset_chat(self, chat_id):
+		raise NotImplementedError
+
+	# Delete the expired preferences of the chats that are not persistent,
+	# i.e. those written before the last reset time of their chat, for at
+	# most time_budget seconds; returns True when all the chats have been
+	# processed. The chats themselves are not reset: their members have
+	# already been ignored since their reset time.
+	def purge_expired(self, resume=False, time_budget=None):
+		raise NotImplementedError
+
+	# Members of a chat that expired at the cutoff, including those saved
+	# before timestamps were kept
+	def expired_ids(self, members, cutoff):
+		return [m['id'] for m in members
+			if m.get('timestamp') is None or m['timestamp'] < cutoff * 1000]
+
+	# Free the space taken by expired or reset preferences; returns True
+	# when there is nothing left to clean up
+	def cleanup(self, time_budget=None):
+		return True
+
+	# Mark an update as processed, to recognise the retries of Telegram
+	# across instances; returns False if the update was already claimed
+	# less than ttl seconds ago
+	def claim_update(self, update_id, ttl):
+		raise NotImplementedError
+
+	# Forget an update whose processing failed, so that a retry is processed
+	def release_update(self, update_id):
+		raise NotImplementedError
+
+	# Records of all the chats (see chat_record and person_record), read
+	# page_size chats at a time. Expired preferences are exported too, with
+	# their timestamp, and expire in the same way once imported.
+	def export_records(self, page_size=100):
+		raise NotImplementedError
+
+	# Write the records of export_records, batch_size at a time: the
+	# settings of the chats are updated and their members added or replaced.
+	# Returns the number of records.
+	def import_records(self, records, batch_size=MAX_BATCH):
+		count = 0
+		ops = {}
+		for record in records:
+			count += 1
+			if record['kind'] == 'Chat':
+				self.set_chat_settings(record['id'], record['settings'])
+			else:
+				ops.setdefault(record['chat'], {})[record['id']] = record_member(record)
+			if count % batch_size == 0:
+				self.put_import_batch(ops)
+				ops = {}
+		self.put_import_batch(ops)
+		return count
+
+	def put_import_batch(self, ops):
+		for chat_id, chat_ops in ops.items():
+			self.put_preferences(chat_id, chat_ops)
+
+
+# Everything kept in the memory of the process, for tests and benchmarks
+class MemoryStore(Store):
+	def __init__(self, **kwargs):
+		Store.__init__(self, **kwargs)
+		self._chats = {}
+		# claimed updates, in order of expiry
+		self._updates = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def _chat(self, chat_id):
+		if chat_id not in self._chats:
+			self._chats[chat_id] = {'settings': {'persistent': False}, 'people': {}}
+		return self._chats[chat_id]
+
+	def put_preferences(self, chat_id, ops):
+		with self._lock:
+			chat = self._chat(chat_id)
+			people = chat['people']
+			for person_id, member in ops.items():
+				if member is None:
+					people.pop(person_id, None)
+				else:
+					people[person_id] = dict(member, id=person_id)
+			return {name: chat['settings'].get(name) for name in CHAT_SETTINGS}
+
+	def _members(self, chat_id):
+		with self._lock:
+			chat = self._chats.get(chat_id, {'settings': {}, 'people': {}})
+			settings = {name: chat['settings'].get(name) for name in CHAT_SETTINGS}
+			return list(chat['people'].values()), settings
+
+	def fetch_chat(self, chat_id):
+		members, settings = self._members(chat_id)
+		return build_chat_summary(members), settings
+
+	def set_chat_settings(self, chat_id, settings):
+		with self._lock:
+			self._chat(chat_id)['settings'].update(settings)
+
+	def reset_chat(self, chat_id, reset_time=None):
+		with self._lock:
+			chat = self._chat(chat_id)
+			chat['people'] = {}
+			chat['settings']['last_reset'] = reset_time or math.floor(time.time())
+
+	def purge_expired(self, resume=False, time_budget=None):
+		changed = []
+		with self._lock:
+			for chat_id, chat in self._chats.items():
+				cutoff = self.last_reset_cutoff(chat['settings'])
+				if cutoff is None:
+					continue
+				expired = self.expired_ids(list(chat['people'].values()), cutoff)
+				for person_id in expired:
+					del chat['people'][person_id]
+				if expired:
+					changed.append(chat_id)
+		for chat_id in changed:
+			self.changed(chat_id)
+		return True
+
+	def claim_update(self, update_id, ttl):
+		now = time.time()
+		with self._lock:
+			while self._updates and next(iter(self._updates.values())) < now:
+				self._updates.popitem(last=False)
+			expires = self._updates.get(update_id)
+			if expires is not None and expires >= now:
+				return False
+			self._updates.pop(update_id, None)
+			self._updates[update_id] = now + ttl
+			return True
+
+	def release_update(self, update_id):
+		with self._lock:
+			self._updates.pop(update_id, None)
+
+	def export_records(self, page_size=100):
+		with self._lock:
+			chats = [(chat_id, dict(chat['settings']), list(chat['people'].values()))
+				for chat_id, chat in self._chats.items()]
+		for chat_id, settings, members in chats:
+			yield chat_record(chat_id, settings)
+			for member in build_chat_summary(members)['members']:
+				yield person_record(chat_id, member)
+
+
+# SQLite database in WAL mode, for self-hosted instances: readers do not
+# block the writer, and the people are indexed by chat. Every thread uses
+# its own connection.
+class SqliteStore(Store):
+	SCHEMA = [
+		'''CREATE TABLE IF NOT EXISTS chats (
+			chat_id INTEGER PRIMARY KEY,
+			persistent INTEGER NOT NULL DEFAULT 0,
+			settings TEXT NOT NULL DEFAULT '{}')''',
+		'''CREATE INDEX IF NOT EXISTS chats_persistent ON chats (persistent)''',
+		'''CREATE TABLE IF NOT EXISTS people (
+			chat_id INTEGER NOT NULL,
+			person_id TEXT NOT NULL,
+			name TEXT NOT NULL,
+			preference TEXT NOT NULL,
+			seats INTEGER NOT NULL,
+			timestamp INTEGER,
+			PRIMARY KEY (chat_id, person_id))''',
+		'''CREATE TABLE IF NOT EXISTS updates (
+			update_id INTEGER PRIMARY KEY,
+			expires REAL NOT NULL)''',
+		'''CREATE INDEX IF NOT EXISTS updates_expires ON updates (expires)''',
+	]
+
+	def __init__(self, path, **kwargs):
+		Store.__init__(self, **kwargs)
+		self.path = path
+		self._local = threading.local()
+		with self._connection() as conn:
+			for statement in self.SCHEMA:
+				conn.execute(statement)
+
+	def _connection(self):
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = sqlite3.connect(self.path, timeout=30)
+			conn.execute('PRAGMA journal_mode=WAL')
+			conn.execute('PRAGMA synchronous=NORMAL')
+			self._local.conn = conn
+		return conn
+
+	def _ensure_chat(self, conn, chat_id):
+		conn.execute('INSERT OR IGNORE INTO chats (chat_id) VALUES (?)', (chat_id,))
+
+	def _settings(self, conn, chat_id):
+		row = conn.execute('SELECT persistent, settings FROM chats WHERE chat_id = ?',
+			(chat_id,)).fetchone()
+		settings = {name: None for name in CHAT_SETTINGS}
+		if row is not None:
+			settings.update(json.loads(row[1]))
+			settings['persistent'] = bool(row[0])
+		return settings
+
+	def _members(self, conn, chat_id):
+		rows = conn.execute('''SELECT person_id, name, preference, seats, timestamp
+			FROM people WHERE chat_id = ?''', (chat_id,))
+		# person ids are stored as JSON, to tell user ids from guest names
+		return [{'id': json.loads(r[0]), 'name': r[1], 'preference': r[2],
+			'seats': r[3], 'timestamp': r[4]} for r in rows]
+
+	def put_preferences(self, chat_id, ops):
+		with self._connection() as conn:
+			self._ensure_chat(conn, chat_id)
+			for person_id, member in ops.items():
+				if member is None:
+					conn.execute('DELETE FROM people WHERE chat_id = ? AND person_id = ?',
+						(chat_id, json.dumps(person_id)))
+				else:
+					conn.execute('''INSERT OR REPLACE INTO people
+						(chat_id, person_id, name, preference, seats, timestamp)
+						VALUES (?, ?, ?, ?, ?, ?)''',
+						(chat_id, json.dumps(person_id), member['name'],
+						member['preference'], member['seats'], member.get('timestamp')))
+			return self._settings(conn, chat_id)
+
+	def fetch_chat(self, chat_id):
+		conn = self._connection()
+		with conn:
+			settings = self._settings(conn, chat_id)
+			members = self._members(conn, chat_id)
+		return build_chat_summary(members), settings
+
+	def set_chat_settings(self, chat_id, settings):
+		settings = dict(settings)
+		with self._connection() as conn:
+			self._ensure_chat(conn, chat_id)
+			if 'persistent' in settings:
+				conn.execute('UPDATE chats SET persistent = ? WHERE chat_id = ?',
+					(int(bool(settings.pop('persistent'))), chat_id))
+			stored = self._settings(conn, chat_id)
+			stored.update(settings)
+			del stored['persistent']
+			conn.execute('UPDATE chats SET settings = ? WHERE chat_id = ?',
+				(json.dumps({k: v for k, v in stored.items() if v is not None}), chat_id))
+
+	def reset_chat(self, chat_id, reset_time=None):
+		self.set_chat_settings(chat_id,
+			{'last_reset': reset_time or math.floor(time.time())})
+		with self._connection() as conn:
+			conn.execute('DELETE FROM people WHERE chat_id = ?', (chat_id,))
+
+	def purge_expired(self, resume=False, time_budget=None):
+		conn = self._connection()
+		chat_ids = [r[0] for r in
+			conn.execute('SELECT chat_id FROM chats WHERE persistent = 0')]
+		for chat_id in chat_ids:
+			with self._connection() as conn:
+				cutoff = self.last_reset_cutoff(self._settings(conn, chat_id))
+				if cutoff is None:
+					continue
+				deleted = conn.execute('DELETE FROM people WHERE chat_id = ? '
+					'AND (timestamp IS NULL OR timestamp < ?)',
+					(chat_id, cutoff * 1000)).rowcount
+			if deleted:
+				self.changed(chat_id)
+		return True
+
+	def claim_update(self, update_id, ttl):
+		now = time.time()
+		with self._connection() as conn:
+			conn.execute('DELETE FROM updates WHERE expires < ?', (now,))
+			cursor = conn.execute('INSERT OR IGNORE INTO updates VALUES (?, ?)',
+				(update_id, now + ttl))
+			return cursor.rowcount == 1
+
+	def release_update(self, update_id):
+		with self._connection() as conn:
+			conn.execute('DELETE FROM updates WHERE update_id = ?', (update_id,))
+
+	def export_records(self, page_size=100):
+		conn = self._connection()
+		last = None
+		while True:
+			if last is None:
+				page = conn.execute('''SELECT chat_id FROM chats
+					ORDER BY chat_id LIMIT ?''', (page_size,)).fetchall()
+			else:
+				page = conn.execute('''SELECT chat_id FROM chats
+					WHERE chat_id > ? ORDER BY chat_id LIMIT ?''',
+					(last, page_size)).fetchall()
+			if not page:
+				return
+			for (chat_id,) in page:
+				with conn:
+					settings = self._settings(conn, chat_id)
+					members = self._members(conn, chat_id)
+				yield chat_record(chat_id, settings)
+				for member in build_chat_summary(members)['members']:
+					yield person_record(chat_id, member)
+			last = page[-1][0]
+
+	# A whole batch is written in one SQLite transaction
+	def put_import_batch(self, ops):
+		with self._connection() as conn:
+			for chat_id, chat_ops in ops.items():
+				self._ensure_chat(conn, chat_id)
+				conn.executemany('''INSERT OR REPLACE INTO people
+					(chat_id, person_id, name, preference, seats, timestamp)
+					VALUES (?, ?, ?, ?, ?, ?)''',
+					[(chat_id, json.dumps(person_id), m['name'], m['preference'],
+					m['seats'], m['timestamp']) for person_id, m in chat_ops.items()])
+
+
+# Google Cloud Datastore. Every chat is a Chat entity, with the members as
+# child Person entities. The Chat entity also carries a summary of the
+# members, kept up to date transactionally with the Person entities, so that
+# a chat can be read with a single get.
+#
+# With reset_mode = 'generation', each chat has a generation number,
+# stamped on the Person entities when they are written. A reset only
+# increments the generation of the chat and empties its summary; the Person
+# entities of older generations are ignored and deleted later by
+# cleanup_stale_people.
+class DatastoreStore(Store):
+	def __init__(self, client=None, reset_mode='delete', page_size=100,
+			workers=8, **kwargs):
+		Store.__init__(self, **kwargs)
+		self._client = client
+		self._client_lock = threading.Lock()
+		self.reset_mode = reset_mode
+		self.page_size = page_size
+		self.workers = workers
+		# background cleanup of the chats reset in generation mode
+		self.cleanup_pool = concurrent.futures.ThreadPoolExecutor(1)
+
+	# The client is created on first use, to keep the instance start fast;
+	# raises DefaultCredentialsError when no credentials are available
+	@property
+	def client(self):
+		if self._client is None:
+			with self._client_lock:
+				if self._client is None:
+					from google.cloud import datastore
+					self._client = datastore.Client()
+		return self._client
+
+	def entity(self, key, exclude_from_indexes=()):
+		from google.cloud import datastore
+		return datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
+
+	# New Chat entity; the persistent flag is always written, so that the
+	# reset job can select the chats to purge with a query
+	def new_chat_entity(self, chat_key):
+		chat_entity = self.entity(chat_key)
+		chat_entity['persistent'] = False
+		return chat_entity
+
+	# Run fn inside a datastore transaction, retrying on contention
+	def run_in_transaction(self, fn, retries=3):
+		import google.api_core.exceptions
+
+		for attempt in range(retries):
+			try:
+				with self.client.transaction():
+					return fn()
+			except google.api_core.exceptions.Conflict:
+				if attempt == retries - 1:
+					raise
+
+	def write_chat_summary(self, chat_entity, members):
+		chat_entity['summary'] = json.dumps(build_chat_summary(members))
+		chat_entity.exclude_from_indexes.add('summary')
+
+	def read_chat_summary(self, chat_entity):
+		if 'summary' not in chat_entity:
+			return None
+		return json.loads(chat_entity['summary'])
+
+	def chat_settings(self, chat_entity):
+		return {name: chat_entity.get(name) for name in CHAT_SETTINGS}
+
+	# Get all the people of a chat with a single ancestor query. People
+	# written before the last reset of the chat in generation mode are
+	# ignored if the current generation is given.
+	#
+	# Only the properties needed by the roster are read, with a projection
+	# query served from the composite indexes in index.yaml. Entities that
+	# lack a projected property are not returned by such a query: that is
+	# why generation is only projected once the chat has been reset in
+	# generation mode, when the people without it are stale anyway.
+	def query_people(self, chat_id, generation=None):
+		ancestor = self.client.key('Chat', chat_id)
+		projection = list(PERSON_PROJECTION)
+		if generation:
+			projection.append('generation')
+		query = self.client.query(kind='Person', ancestor=ancestor,
+			projection=projection)
+		people = query.fetch()
+		if generation:
+			people = [p for p in people if p['generation'] >= generation]
+		return [{'id': p.key.id_or_name, 'name': p['name'],
+			'preference': p['preference'], 'seats': p['seats'],
+			'timestamp': p['timestamp']} for p in people]
+
+	# Members of a chat that have not expired, from the summary or, for chats
+	# written before the summary existed, from the Person entities
+	def load_chat_members(self, chat_entity, from_people=False):
+		summary = self.read_chat_summary(chat_entity)
+		if summary is not None and not from_people:
+			members = summary['members']
+		else:
+			members = self.query_people(chat_entity.key.id_or_name,
+				chat_entity.get('generation', 0))
+		return self.live_members(members, self.chat_settings(chat_entity))
+
+	def person_entity(self, rec_key, member, generation=0):
+		rec = self.entity(rec_key)
+		rec['name'] = member['name']
+		rec['preference'] = member['preference']
+		rec['seats'] = member['seats']
+		rec['timestamp'] = member['timestamp']
+		rec['generation'] = generation
+		return rec
+
+	# Write, in a single transaction, the changes to the Person entities of a
+	# chat and the updated chat summary
+	def put_preferences(self, chat_id, ops):
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			chat_entity = self.client.get(chat_key)
+			existed = chat_entity is not None
+			if not existed:
+				chat_entity = self.new_chat_entity(chat_key)
+			old_members = self.load_chat_members(chat_entity)
+			members = [m for m in old_members if m['id'] not in ops]
+			puts = []
+			deletes = []
+			for person_id, member in ops.items():
+				rec_key = self.client.key('Chat', chat_id, 'Person', person_id)
+				if member is None:
+					deletes.append(rec_key)
+					continue
+				members.append(dict(member, id=person_id))
+				puts.append(self.person_entity(rec_key, member,
+					chat_entity.get('generation', 0)))
+
+			# the summary only changes if someone was added or removed
+			if puts or len(members) != len(old_members) or \
+					(existed and 'summary' not in chat_entity):
+				self.write_chat_summary(chat_entity, members)
+				puts.append(chat_entity)
+			if puts:
+				self.client.put_multi(puts)
+			if deletes:
+				self.client.delete_multi(deletes)
+			return self.chat_settings(chat_entity)
+		return self.run_in_transaction(txn)
+
+	def fetch_chat(self, chat_id):
+		chat_entity = self.get_chat_with_summary(chat_id)
+		return self.read_chat_summary(chat_entity), self.chat_settings(chat_entity)
+
+	# Chat entity with an up-to-date summary
+	def get_chat_with_summary(self, chat_id):
+		chat_key = self.client.key('Chat', chat_id)
+		chat_entity = self.client.get(chat_key)
+		if chat_entity is None:
+			# nothing has been written in this chat yet: there is no need to
+			# create the entity just to read it
+			chat_entity = self.new_chat_entity(chat_key)
+			self.write_chat_summary(chat_entity, [])
+		elif 'summary' not in chat_entity:
+			chat_entity = self.rebuild_chat_summary(chat_id)
+		return chat_entity
+
+	# Recompute the summary of a chat from its Person entities
+	def rebuild_chat_summary(self, chat_id):
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			chat_entity = self.client.get(chat_key)
+			if not chat_entity:
+				chat_entity = self.new_chat_entity(chat_key)
+			members = self.load_chat_members(chat_entity, from_people=True)
+			self.write_chat_summary(chat_entity, members)
+			self.client.put(chat_entity)
+			return chat_entity
+		chat_entity = self.run_in_transaction(txn)
+		self.changed(chat_id)
+		return chat_entity
+
+	def rebuild_summaries(self):
+		q = self.client.query(kind='Chat')
+		q.keys_only()
+		for el in q.fetch():
+			self.rebuild_chat_summary(el.key.id_or_name)
+
+	def set_chat_settings(self, chat_id, settings):
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			chat_entity = self.client.get(chat_key)
+			if not chat_entity:
+				chat_entity = self.new_chat_entity(chat_key)
+			chat_entity.update(settings)
+			self.client.put(chat_entity)
+		self.run_in_transaction(txn)
+
+	def reset_chat(self, chat_id):
+		if self.reset_mode == 'generation':
+			self.new_generation(chat_id, math.floor(time.time()))
+			self.cleanup_pool.submit(self.cleanup_stale_people, chat_id)
+			return
+
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			query = self.client.query(kind='Person', ancestor=chat_key)
+			query.keys_only()
+			keys = [r.key for r in query.fetch()]
+			self.client.delete_multi(keys)
+
+			chat_entity = self.client.get(chat_key)
+			if not chat_entity:
+				chat_entity = self.new_chat_entity(chat_key)
+			chat_entity['last_reset'] = math.floor(time.time())
+			self.write_chat_summary(chat_entity, [])
+			self.client.put(chat_entity)
+		self.run_in_transaction(txn)
+
+	def new_generation(self, chat_id, reset_time):
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			chat_entity = self.client.get(chat_key)
+			if chat_entity is None:
+				chat_entity = self.new_chat_entity(chat_key)
+			chat_entity['generation'] = chat_entity.get('generation', 0) + 1
+			chat_entity['needs_cleanup'] = True
+			chat_entity['last_reset'] = reset_time
+			self.write_chat_summary(chat_entity, [])
+			self.client.put(chat_entity)
+		self.run_in_transaction(txn)
+		self.changed(chat_id)
+
+	# Delete the Person entities of the older generations of a chat. This
+	# runs in a transaction, so that a person writing a new preference
+	# meanwhile is not deleted.
+	def cleanup_stale_people(self, chat_id):
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			chat_entity = self.client.get(chat_key)
+			if chat_entity is None:
+				return
+			generation = chat_entity.get('generation', 0)
+			query = self.client.query(kind='Person', ancestor=chat_key)
+			stale = [p.key for p in query.fetch()
+				if p.get('generation', 0) < generation]
+			self.client.delete_multi(stale)
+			chat_entity['needs_cleanup'] = False
+			self.client.put(chat_entity)
+		self.run_in_transaction(txn)
+
+	# Each claimed update is an Update entity, keyed on the update id
+	def claim_update(self, update_id, ttl):
+		update_key = self.client.key('Update', update_id)
+
+		def txn():
+			now = time.time()
+			update = self.client.get(update_key)
+			if update is not None and update['expires'] >= now:
+				return False
+			update = self.entity(update_key)
+			update['expires'] = now + ttl
+			self.client.put(update)
+			return True
+		return self.run_in_transaction(txn)
+
+	def release_update(self, update_id):
+		self.client.delete(self.client.key('Update', update_id))
+
+	def delete_expired_updates(self):
+		q = self.client.query(kind='Update')
+		q.add_filter('expires', '<', time.time())
+		q.keys_only()
+		while True:
+			keys = [el.key for el in q.fetch(limit=MAX_BATCH)]
+			if not keys:
+				return
+			self.client.delete_multi(keys)
+
+	# Delete the expired Update entities and clean up the chats reset in
+	# generation mode
+	def cleanup(self, time_budget=None):
+		deadline = None
+		if time_budget is not None:
+			deadline = time.monotonic() + time_budget
+		self.delete_expired_updates()
+		with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+			while True:
+				q = self.client.query(kind='Chat')
+				q.add_filter('needs_cleanup', '=', True)
+				q.keys_only()
+				page = list(q.fetch(limit=self.page_size))
+				if not page:
+					return True
+				list(pool.map(self.cleanup_stale_people,
+					[el.key.id_or_name for el in page]))
+				if deadline is not None and time.monotonic() > deadline:
+					return False
+
+	# Nightly purge of the expired preferences. Chats are read a page at a
+	# time and the chats of a page are processed concurrently, each in its
+	# own transaction. The cursor of the next page is stored in a Job entity, so
+	# that a run cut off by the request deadline can be resumed; the run
+	# holds a lease on the Job while it works, so that a resumed run does not
+	# start while the previous one is still going.
+
+	# Delete the expired Person entities of a chat and remove them from its
+	# summary; the query and the deletion run in the same transaction, so
+	# that a person writing a preference meanwhile is kept
+	def purge_expired_chat(self, chat_id):
+		chat_key = self.client.key('Chat', chat_id)
+
+		def txn():
+			chat_entity = self.client.get(chat_key)
+			if chat_entity is None:
+				return False
+			cutoff = self.last_reset_cutoff(self.chat_settings(chat_entity))
+			if cutoff is None:
+				return False
+			query = self.client.query(kind='Person', ancestor=chat_key)
+			people = [{'id': p.key.id_or_name, 'timestamp': p.get('timestamp')}
+				for p in query.fetch()]
+			expired = set(self.expired_ids(people, cutoff))
+			if not expired:
+				return False
+			self.client.delete_multi([self.client.key('Chat', chat_id, 'Person', i)
+				for i in expired])
+			members = [m for m in self.load_chat_members(chat_entity)
+				if m['id'] not in expired]
+			self.write_chat_summary(chat_entity, members)
+			self.client.put(chat_entity)
+			return True
+		if self.run_in_transaction(txn):
+			self.changed(chat_id)
+
+	# Take the lease on the Job entity, unless another run holds it; returns
+	# the Job, or None
+	def acquire_job(self, job_key, owner, resume):
+		def txn():
+			now = time.time()
+			job = self.client.get(job_key)
+			if job is not None and job.get('lease_expires', 0) > now:
+				return None
+			if job is None or not resume:
+				# a new run starts from the first chat
+				job = self.entity(job_key, exclude_from_indexes=('cursor',))
+				job['cursor'] = None
+			job['owner'] = owner
+			job['lease_expires'] = now + JOB_LEASE
+			job['timestamp'] = math.floor(now)
+			self.client.put(job)
+			return job
+		return self.run_in_transaction(txn)
+
+	# Save the cursor of the next page and renew the lease, or release it;
+	# returns False if the lease has been taken over by another run
+	def renew_job(self, job_key, owner, cursor, release):
+		def txn():
+			job = self.client.get(job_key)
+			if job is None or job.get('owner') != owner:
+				return False
+			now = time.time()
+			job['cursor'] = cursor
+			job['timestamp'] = math.floor(now)
+			job['lease_expires'] = 0 if release else now + JOB_LEASE
+			self.client.put(job)
+			return True
+		return self.run_in_transaction(txn)
+
+	def purge_expired(self, resume=False, time_budget=None):
+		deadline = None
+		if time_budget is not None:
+			deadline = time.monotonic() + time_budget
+		job_key = self.client.key('Job', 'deleteprefs')
+		if resume and self.client.get(job_key) is None:
+			# nothing to resume
+			return True
+		owner = uuid.uuid4().hex
+		job = self.acquire_job(job_key, owner, resume)
+		if job is None:
+			# another run is still working
+			return False
+		cursor = job['cursor']
+
+		with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+			while True:
+				q = self.client.query(kind='Chat')
+				q.add_filter('persistent', '=', False)
+				q.keys_only()
+				it = q.fetch(limit=self.page_size, start_cursor=cursor)
+				page = list(next(it.pages, []))
+				list(pool.map(self.purge_expired_chat,
+					[el.key.id_or_name for el in page]))
+
+				cursor = it.next_page_token
+				if not page or cursor is None:
+					self.client.delete(job_key)
+					return True
+				if isinstance(cursor, bytes):
+					cursor = cursor.decode('ascii')
+				out_of_time = deadline is not None and time.monotonic() > deadline
+				if not self.renew_job(job_key, owner, cursor, out_of_time):
+					# the lease expired and another run took over
+					return False
+				if out_of_time:
+					return False
+
+	# One-off migration: write persistent = False on the chats created before
+	# the flag was always written, which the reset job would otherwise skip
+	def backfill_persistent(self):
+		def txn(chat_key):
+			chat_entity = self.client.get(chat_key)
+			if chat_entity is not None and 'persistent' not in chat_entity:
+				chat_entity['persistent'] = False
+				self.client.put(chat_entity)
+
+		updated = 0
+		cursor = None
+		while True:
+			q = self.client.query(kind='Chat')
+			it = q.fetch(limit=self.page_size, start_cursor=cursor)
+			page = list(next(it.pages, []))
+			for el in page:
+				if 'persistent' not in el:
+					self.run_in_transaction(lambda: txn(el.key))
+					updated += 1
+			cursor = it.next_page_token
+			if not page or cursor is None:
+				return updated
+
+	def export_records(self, page_size=100):
+		cursor = None
+		while True:
+			q = self.client.query(kind='Chat')
+			it = q.fetch(limit=page_size, start_cursor=cursor)
+			page = list(next(it.pages, []))
+			for chat_entity in page:
+				chat_id = chat_entity.key.id_or_name
+				yield chat_record(chat_id, self.chat_settings(chat_entity))
+				members = self.query_people(chat_id, chat_entity.get('generation', 0))
+				for member in build_chat_summary(members)['members']:
+					yield person_record(chat_id, member)
+			cursor = it.next_page_token
+			if not page or cursor is None:
+				return
+
+	# The entities are written with batched put_multi calls, outside
+	# transactions, so the import is meant for a project that is not serving
+	# the same chats. The Chat entities replace the existing ones and are
+	# written without summary, after the people of the chat: the summary is
+	# rebuilt from the Person entities on first read.
+	def import_records(self, records, batch_size=MAX_BATCH):
+		count = 0
+		batch = []
+		chat_entity = None
+		for record in records:
+			count += 1
+			if record['kind'] == 'Chat':
+				if chat_entity is not None:
+					batch.append(chat_entity)
+				chat_entity = self.new_chat_entity(
+					self.client.key('Chat', record['id']))
+				chat_entity.update(record['settings'])
+			else:
+				rec_key = self.client.key('Chat', record['chat'], 'Person', record['id'])
+				batch.append(self.person_entity(rec_key, record_member(record)))
+			if len(batch) >= batch_size:
+				self.client.put_multi(batch)
+				batch = []
+		if chat_entity is not None:
+			batch.append(chat_entity)
+		if batch:
+			self.client.put_multi(batch)
+		return count
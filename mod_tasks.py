@@ -0,0 +1,67 @@
+# Push queues for the deferred processing of the updates: the webhook only
+# enqueues the update, and the queue posts it back to an endpoint of the
+# app, retrying while the endpoint fails.
+#
+# CloudTasksQueue creates an App Engine task in a Cloud Tasks queue;
+# LocalTaskQueue is the stand-in used locally and in tests, which posts the
+# tasks to the Flask app from a background thread.
+
+import concurrent.futures
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Header set on the requests of the push queues; App Engine removes it from
+# the requests coming from outside
+QUEUE_HEADER = 'X-AppEngine-QueueName'
+
+
+class CloudTasksQueue:
+	def __init__(self, queue_path):
+		# projects/<project>/locations/<location>/queues/<queue>
+		self.queue_path = queue_path
+		self._client = None
+		self._lock = threading.Lock()
+
+	@property
+	def client(self):
+		if self._client is None:
+			with self._lock:
+				if self._client is None:
+					from google.cloud import tasks_v2
+					self._client = tasks_v2.CloudTasksClient()
+		return self._client
+
+	def push(self, relative_uri, payload):
+		task = {
+			'app_engine_http_request': {
+				'http_method': 'POST',
+				'relative_uri': relative_uri,
+				'headers': {'Content-Type': 'application/json'},
+				'body': json.dumps(payload).encode('utf-8'),
+			},
+		}
+		self.client.create_task(parent=self.queue_path, task=task)
+
+
+class LocalTaskQueue:
+	def __init__(self, app, max_retries=3):
+		self.app = app
+		self.max_retries = max_retries
+		# a single worker, so that the tasks run in the order they were pushed
+		self.pool = concurrent.futures.ThreadPoolExecutor(1)
+
+	def push(self, relative_uri, payload):
+		return self.pool.submit(self._post, relative_uri, payload)
+
+	def _post(self, relative_uri, payload):
+		client = self.app.test_client()
+		for attempt in range(self.max_retries + 1):
+			resp = client.post(relative_uri, json=payload,
+				headers={QUEUE_HEADER: 'local'})
+			if resp.status_code == 200:
+				return
+		logger.error("Giving up task %s after %d attempts", relative_uri,
+			self.max_retries + 1)
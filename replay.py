@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Replay the updates recorded by mod_recorder (record_updates in config.ini)
+# against the webhook, and report the latency and the error rate of every
+# command. Run it from the project directory, where config.ini is.
+#
+#   python replay.py updates.jsonl [--speed 2] [--url https://<app>/<hook>]
+#
+# Without --url the updates are posted to the Flask app in this process,
+# with the preferences kept in memory (unless --storage is given) and
+# nothing sent to Telegram or recorded again, whatever config.ini says.
+# --speed 2 replays twice as fast as the updates were received, --speed 0
+# as fast as possible. The latency of an update is measured from the time
+# it was due to be sent, so it includes the time it waited for one of the
+# --workers.
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import threading
+import time
+
+import requests
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Replay recorded updates.")
+	parser.add_argument('recording')
+	parser.add_argument('--url', help="webhook of a running instance")
+	parser.add_argument('--speed', type=float, default=1,
+		help="speed multiplier, 0 to replay as fast as possible")
+	parser.add_argument('--workers', type=int, default=8,
+		help="updates in flight at the same time")
+	parser.add_argument('--storage', choices=['datastore', 'memory', 'sqlite'],
+		default='memory', help="store used without --url")
+	parser.add_argument('--sqlite-path')
+	return parser.parse_args()
+
+def read_recording(path):
+	with open(path, encoding='utf-8') as f:
+		for line in f:
+			if line.strip():
+				entry = json.loads(line)
+				yield entry['received'], entry['update']
+
+# Command of an update, e.g. /status, without the bot name
+def command_of(update):
+	message = update.get('message') or update.get('edited_message') or {}
+	text = message.get('text') or ''
+	if not text.startswith('/'):
+		return '(other)'
+	return text.split()[0].split('@')[0].lower()
+
+# Request layer of the bot that answers every call of the Bot API locally,
+# as Telegram would, without any network traffic
+class OfflineRequest:
+	def __init__(self):
+		self.message_ids = itertools.count(1)
+
+	def get(self, url, timeout=None):
+		return self.post(url, {}, timeout)
+
+	def post(self, url, data, timeout=None):
+		method = url.rsplit('/', 1)[-1]
+		if method == 'getMe':
+			return {'id': 0, 'first_name': 'Autobot', 'is_bot': True,
+				'username': 'autobot'}
+		if method in ('sendMessage', 'editMessageText'):
+			return {'message_id': data.get('message_id') or next(self.message_ids),
+				'date': int(time.time()), 'text': data.get('text'),
+				'chat': {'id': data.get('chat_id'), 'type': 'group'}}
+		return True
+
+# Point main.py at the local store and at a bot that does not talk to
+# Telegram; the outbound workers, which post to the Bot API themselves,
+# and the recorder are turned off
+def setup_local(storage, sqlite_path):
+	import telegram
+	import main
+
+	main.store = main.LazyObject(lambda: main.build_store(storage, sqlite_path))
+	main.telegrambot = main.LazyObject(
+		lambda: telegram.Bot(main.TELEGRAM_TOKEN, request=OfflineRequest()))
+	main.outbound = None
+	main.recorder = None
+	if main.task_queue is not None:
+		main.task_queue = main.mod_tasks.LocalTaskQueue(main.app)
+	return main
+
+# Post function that runs the updates through the Flask app of main.py
+def local_poster(storage, sqlite_path):
+	main = setup_local(storage, sqlite_path)
+	# one test client for every worker thread
+	local = threading.local()
+
+	def post(update):
+		if not hasattr(local, 'client'):
+			local.client = main.app.test_client()
+		return local.client.post(main.HOOK_ADDRESS, json=update).status_code
+	return post
+
+def remote_poster(url):
+	session = requests.Session()
+
+	def post(update):
+		return session.post(url, json=update, timeout=60).status_code
+	return post
+
+def percentile(values, p):
+	values = sorted(values)
+	index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+	return values[index]
+
+def replay(entries, post, speed, workers):
+	latencies = collections.defaultdict(list)
+	errors = collections.Counter()
+	lock = threading.Lock()
+
+	def run(update, start):
+		command = command_of(update)
+		try:
+			ok = post(update) == 200
+		except Exception:
+			ok = False
+		elapsed = time.monotonic() - start
+		with lock:
+			latencies[command].append(elapsed * 1000)
+			if not ok:
+				errors[command] += 1
+
+	started = time.monotonic()
+	first = None
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		for received, update in entries:
+			if first is None:
+				first = received
+			due = time.monotonic()
+			if speed > 0:
+				due = started + (received - first) / speed
+				delay = due - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+			pool.submit(run, update, due)
+	return latencies, errors, time.monotonic() - started
+
+def report(latencies, errors, elapsed):
+	total = sum(len(l) for l in latencies.values())
+	print("%d updates in %.1f s (%.1f updates/s)" %
+		(total, elapsed, total / elapsed if elapsed else 0))
+	print("%-16s %7s %9s %9s %9s %9s %7s" %
+		('command', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors'))
+	for command in sorted(latencies, key=lambda c: -len(latencies[c])):
+		l = latencies[command]
+		print("%-16s %7d %9.1f %9.1f %9.1f %9.1f %6.1f%%" %
+			(command, len(l), percentile(l, 50), percentile(l, 90),
+			percentile(l, 99), max(l), 100 * errors[command] / len(l)))
+
+if __name__ == '__main__':
+	args = parse_args()
+	if args.url:
+		post = remote_poster(args.url)
+	else:
+		post = local_poster(args.storage, args.sqlite_path)
+	report(*replay(read_recording(args.recording), post, args.speed, args.workers))
@@ -0,0 +1,43 @@
+# The default allocator must use the same minimum number of cars as the
+# reference PuLP solver.
+
+import random
+
+import pytest
+
+import mod_allocator
+
+
+def random_cases(count, seed=0):
+	rnd = random.Random(seed)
+	for i in range(count):
+		buckets = [rnd.randint(0, 3) for k in range(mod_allocator.NUM_SEAT_BUCKETS)]
+		seats = sum(k * n for k, n in enumerate(buckets, 1))
+		yield buckets, rnd.randint(0, seats)
+
+def assert_valid(buckets, num_people, counts):
+	assert len(counts) == mod_allocator.NUM_SEAT_BUCKETS
+	assert all(0 <= c <= n for c, n in zip(counts, buckets))
+	assert sum(k * c for k, c in enumerate(counts, 1)) >= num_people
+
+
+def test_dp_matches_pulp():
+	pytest.importorskip('pulp')
+	dp = mod_allocator.DPAllocator()
+	lp = mod_allocator.PulpAllocator()
+	for buckets, num_people in random_cases(150):
+		counts = dp.allocate(buckets, num_people)
+		assert_valid(buckets, num_people, counts)
+		assert sum(counts) == sum(lp.allocate(buckets, num_people)), \
+			(buckets, num_people)
+
+
+def test_dp_leaves_fewest_empty_seats():
+	# two cars are needed either way: 5 + 5 leaves no seat empty
+	counts = mod_allocator.DPAllocator().allocate([0, 0, 0, 0, 2, 0, 1, 0, 0, 0], 10)
+	assert counts == [0, 0, 0, 0, 2, 0, 0, 0, 0, 0]
+
+
+def test_dp_not_enough_seats():
+	with pytest.raises(ValueError):
+		mod_allocator.DPAllocator().allocate([0, 0, 0, 1, 0, 0, 0, 0, 0, 0], 5)
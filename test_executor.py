@@ -0,0 +1,47 @@
+# Tasks of a chat run one at a time and in order, different chats in
+# parallel.
+
+import threading
+import time
+
+import mod_executor
+
+
+def test_same_key_in_order():
+	executor = mod_executor.ChatExecutor(4)
+	done = []
+	lock = threading.Lock()
+
+	def task(i):
+		time.sleep(0.001 * (5 - i % 5))
+		with lock:
+			done.append(i)
+		return i
+
+	futures = [executor.submit('chat', task, i) for i in range(20)]
+	assert [f.result() for f in futures] == list(range(20))
+	assert done == list(range(20))
+	executor.shutdown()
+
+
+def test_keys_in_parallel():
+	executor = mod_executor.ChatExecutor(2)
+	started = threading.Barrier(2, timeout=2)
+	# both tasks must be running at the same time for the barrier to open
+	futures = [executor.submit(key, started.wait) for key in ('a', 'b')]
+	for f in futures:
+		f.result(timeout=2)
+	executor.shutdown()
+
+
+def test_exception_does_not_block_key():
+	executor = mod_executor.ChatExecutor(1)
+
+	def fail():
+		raise ValueError('boom')
+
+	first = executor.submit('chat', fail)
+	second = executor.submit('chat', lambda: 'ok')
+	assert isinstance(first.exception(timeout=2), ValueError)
+	assert second.result(timeout=2) == 'ok'
+	executor.shutdown()
@@ -0,0 +1,150 @@
+# Updates posted to the Flask app of main.py, with the preferences kept in
+# memory and a bot that records what it would send to Telegram instead of
+# sending it.
+
+import os
+import time
+
+import pytest
+
+import replay
+
+CONFIG = """[DEFAULT]
+telegram_token = 000000000:0
+hook_address = /hook
+bot_url =
+storage = memory
+"""
+
+
+# Bot API stand-in that keeps the calls it receives
+class RecordingRequest(replay.OfflineRequest):
+	def __init__(self):
+		super().__init__()
+		self.calls = []
+
+	def post(self, url, data, timeout=None):
+		self.calls.append((url.rsplit('/', 1)[-1], data))
+		return super().post(url, data, timeout)
+
+	def sent(self):
+		return [data['text'] for method, data in self.calls if method == 'sendMessage']
+
+
+# main.py reads config.ini from the working directory when it is imported
+@pytest.fixture(scope='module')
+def main(tmp_path_factory):
+	try:
+		import telegram
+	except ImportError as e:
+		# python-telegram-bot 11 does not import on recent Pythons
+		pytest.skip("cannot import telegram: %s" % e)
+	path = tmp_path_factory.mktemp('config')
+	(path / 'config.ini').write_text(CONFIG)
+	cwd = os.getcwd()
+	os.chdir(str(path))
+	try:
+		import main
+	finally:
+		os.chdir(cwd)
+	return main
+
+@pytest.fixture
+def bot(main, monkeypatch):
+	import telegram
+
+	request = RecordingRequest()
+	monkeypatch.setattr(main, 'store', main.build_store('memory'))
+	monkeypatch.setattr(main, 'telegrambot', main.LazyObject(
+		lambda: telegram.Bot(main.TELEGRAM_TOKEN, request=request)))
+	monkeypatch.setattr(main, 'dispatcher', main.LazyObject(main.build_dispatcher))
+	monkeypatch.setattr(main, 'outbound', None)
+	monkeypatch.setattr(main, 'recorder', None)
+	for cache in (main.seen_updates, main.roster_cache, main.status_cache):
+		cache.clear()
+	yield request
+	for chat_id in list(main.pending_writes):
+		main.take_pending_writes(chat_id)
+
+def command(update_id, text, chat_id=-5, user_id=7, name='Anna'):
+	return {'update_id': update_id, 'message': {
+		'message_id': update_id, 'date': 0,
+		'chat': {'id': chat_id, 'type': 'group'},
+		'from': {'id': user_id, 'first_name': name, 'is_bot': False},
+		'text': text,
+		'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}}
+
+# Make a method of the store fail on its first call
+def fail_once(monkeypatch, store, name):
+	method = getattr(store, name)
+	failures = [RuntimeError('datastore unavailable')]
+
+	def call(*args, **kwargs):
+		if failures:
+			raise failures.pop()
+		return method(*args, **kwargs)
+	monkeypatch.setattr(store, name, call)
+	return failures
+
+
+def test_single_reply_in_webhook_response(main, bot, monkeypatch):
+	monkeypatch.setattr(main, 'WEBHOOK_REPLY', True)
+	response = main.app.test_client().post('/hook', json=command(1, '/auto'))
+	assert response.status_code == 200
+	assert response.get_json() == {'method': 'sendMessage', 'chat_id': -5,
+		'text': 'Anna ha la macchina.'}
+	assert bot.sent() == []
+
+
+def test_read_after_pending_write(main, bot, monkeypatch):
+	monkeypatch.setattr(main, 'WRITE_BEHIND_DELAY', 60)
+	main.put_pref_ds(-5, 1, 'Anna', 'CAR', 4)
+	assert -5 in main.pending_writes
+	assert main.store.fetch_chat(-5)[0]['members'] == []
+	# the read writes the pending changes first
+	assert 'Anna' in main.compute_status(-5)
+	assert main.pending_writes == {} and main.flush_timers == {}
+	assert [m['name'] for m in main.store.fetch_chat(-5)[0]['members']] == ['Anna']
+
+
+def test_failed_flush_is_retried(main, bot, monkeypatch):
+	monkeypatch.setattr(main, 'WRITE_BEHIND_DELAY', 0.05)
+	failures = fail_once(monkeypatch, main.store, 'put_preferences')
+
+	main.put_pref_ds(-5, 1, 'Anna', 'CAR', 4)
+	# nothing reads the chat: the timer alone must write it again
+	deadline = time.monotonic() + 5
+	while not main.store.fetch_chat(-5)[0]['members']:
+		assert time.monotonic() < deadline, "the failed flush was not retried"
+		time.sleep(0.01)
+	assert failures == []
+	assert [m['name'] for m in main.store.fetch_chat(-5)[0]['members']] == ['Anna']
+	assert main.pending_writes == {}
+
+
+def test_duplicate_update_ignored(main, bot):
+	client = main.app.test_client()
+	assert client.post('/hook', json=command(1, '/auto')).status_code == 200
+	assert client.post('/hook', json=command(1, '/auto')).status_code == 200
+	assert bot.sent() == ['Anna ha la macchina.']
+
+
+def test_claim_failure_releases_update(main, bot, monkeypatch):
+	monkeypatch.setattr(main, 'DEDUP_STORE', True)
+	fail_once(monkeypatch, main.store, 'claim_update')
+
+	client = main.app.test_client()
+	assert client.post('/hook', json=command(1, '/auto')).status_code == 500
+	# the retry of Telegram is processed
+	assert client.post('/hook', json=command(1, '/auto')).status_code == 200
+	assert bot.sent() == ['Anna ha la macchina.']
+
+
+def test_handler_failure_releases_update(main, bot, monkeypatch):
+	fail_once(monkeypatch, main.store, 'put_preferences')
+
+	client = main.app.test_client()
+	assert client.post('/hook', json=command(1, '/auto')).status_code == 500
+	assert bot.sent() == []
+	assert client.post('/hook', json=command(1, '/auto')).status_code == 200
+	assert bot.sent() == ['Anna ha la macchina.']
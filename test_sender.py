@@ -0,0 +1,61 @@
+# Background delivery of the replies: order, rate limits and coalescing.
+# Nothing is sent to Telegram: deliver is replaced by a recorder.
+
+import threading
+
+import mod_sender
+
+
+def recording_sender(**kwargs):
+	sender = mod_sender.OutboundSender('0:T', **kwargs)
+	sent = []
+	lock = threading.Lock()
+
+	def deliver(method, params):
+		with lock:
+			sent.append((method, params['chat_id'], params.get('text')))
+	sender.deliver = deliver
+	return sender, sent
+
+def join(sender, timeout=5):
+	t = threading.Thread(target=sender.join, daemon=True)
+	t.start()
+	t.join(timeout)
+	assert not t.is_alive(), "join() did not return"
+
+
+def test_chat_order():
+	sender, sent = recording_sender(workers=4)
+	for i in range(20):
+		sender.send_message(i % 2, str(i))
+	join(sender)
+	for chat_id in (0, 1):
+		assert [s[2] for s in sent if s[1] == chat_id] == \
+			[str(i) for i in range(chat_id, 20, 2)]
+
+
+def test_coalesce_when_limited():
+	sender, sent = recording_sender(workers=1, chat_rate=600, chat_burst=1)
+	for i in range(4):
+		sender.send_message(1, 'conferma %d' % i, coalesce=True)
+	sender.send_message(1, 'stato')
+	join(sender)
+	texts = [s[2] for s in sent]
+	assert '\n'.join(texts[:-1]) == '\n'.join('conferma %d' % i for i in range(4))
+	assert len(texts) < 5
+	assert texts[-1] == 'stato'
+
+
+def test_global_rate_below_one():
+	sender, sent = recording_sender(global_rate=0.5)
+	sender.send_message(1, 'a')
+	join(sender)
+	assert sent == [('sendMessage', 1, 'a')]
+
+
+def test_try_acquire():
+	sender, sent = recording_sender(chat_rate=60, chat_burst=2)
+	assert sender.try_acquire(1)
+	assert sender.try_acquire(1)
+	assert not sender.try_acquire(1)
+	assert sender.try_acquire(2)
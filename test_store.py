@@ -0,0 +1,108 @@
+# Behaviour shared by the stores that run without external services; the
+# Datastore implementation needs the emulator and is not covered here.
+
+import time
+
+import pytest
+
+import mod_store
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+	options = {'reset_time': '04:00', 'reset_timezone': 'Europe/Rome'}
+	if request.param == 'memory':
+		return mod_store.MemoryStore(**options)
+	return mod_store.SqliteStore(str(tmp_path / 'carpool.db'), **options)
+
+def member(person_id, name, preference='LIFT', seats=5, timestamp=None):
+	if timestamp is None:
+		timestamp = int(time.time() * 1000)
+	return {'id': person_id, 'name': name, 'preference': preference,
+		'seats': seats, 'timestamp': timestamp}
+
+# A timestamp before the last reset of any chat
+def expired():
+	return int((time.time() - 3 * 86400) * 1000)
+
+
+def test_put_and_fetch(store):
+	settings = store.put_preferences(-1, {
+		1: member(1, 'Anna', 'CAR', 4), 2: member(2, 'Bruno'), 'g': member('g', 'Guest')})
+	assert settings['persistent'] is False
+	summary, settings = store.fetch_chat(-1)
+	assert [m['id'] for m in summary['members']] == [1, 2, 'g']
+	assert summary['counts']['CAR'] == 1 and summary['counts']['LIFT'] == 2
+	assert summary['car_buckets'][3] == 1
+
+	store.put_preferences(-1, {2: None, 1: member(1, 'Anna', 'BIKE')})
+	summary, settings = store.fetch_chat(-1)
+	assert [(m['id'], m['preference']) for m in summary['members']] == \
+		[(1, 'BIKE'), ('g', 'LIFT')]
+
+
+def test_settings(store):
+	store.set_chat_settings(-1, {'persistent': True, 'reset_time': '05:30'})
+	settings = store.fetch_chat(-1)[1]
+	assert settings['persistent'] is True and settings['reset_time'] == '05:30'
+	store.set_chat_settings(-1, {'reset_time': None})
+	assert store.fetch_chat(-1)[1]['reset_time'] is None
+	assert store.put_preferences(-1, {1: member(1, 'Anna')})['persistent'] is True
+
+
+def test_reset_chat(store):
+	store.put_preferences(-1, {1: member(1, 'Anna')})
+	store.reset_chat(-1)
+	summary, settings = store.fetch_chat(-1)
+	assert summary['members'] == []
+	assert settings['last_reset'] is not None
+
+
+def test_purge_expired(store):
+	changed = []
+	store.on_change = changed.append
+	store.put_preferences(-1, {1: member(1, 'Anna'), 2: member(2, 'Old', timestamp=expired())})
+	store.put_preferences(-2, {3: member(3, 'Old', timestamp=expired())})
+	store.set_chat_settings(-2, {'persistent': True})
+	store.set_chat_settings(-1, {'last_reset': 123})
+
+	assert store.purge_expired()
+	summary, settings = store.fetch_chat(-1)
+	assert [m['id'] for m in summary['members']] == [1]
+	assert settings['last_reset'] == 123
+	# persistent chats never expire
+	assert [m['id'] for m in store.fetch_chat(-2)[0]['members']] == [3]
+	assert changed == [-1]
+
+
+def test_claim_update(store):
+	assert store.claim_update(1, 60)
+	assert not store.claim_update(1, 60)
+	store.release_update(1)
+	assert store.claim_update(1, 60)
+	assert store.claim_update(2, 0.01)
+	time.sleep(0.02)
+	assert store.claim_update(2, 60)
+
+
+def test_export_import(store, tmp_path):
+	store.put_preferences(-1, {1: member(1, 'Anna', 'CAR', 3), 'g': member('g', 'Guest')})
+	store.set_chat_settings(-1, {'reset_time': '06:00'})
+	store.put_preferences(-2, {2: member(2, 'Bruno', timestamp=expired())})
+	lines = list(mod_store.export_ndjson(store, page_size=1))
+	assert len(lines) == 5
+
+	copy = mod_store.SqliteStore(str(tmp_path / 'copy.db'))
+	assert mod_store.import_ndjson(copy, lines, batch_size=2) == 5
+	for chat_id in (-1, -2):
+		assert copy.fetch_chat(chat_id)[0]['members'] == \
+			store.fetch_chat(chat_id)[0]['members']
+	assert copy.fetch_chat(-1)[1]['reset_time'] == '06:00'
+
+
+def test_last_reset_cutoff():
+	settings = {'reset_time': '04:00', 'reset_timezone': 'Europe/Rome'}
+	# 2024-01-10 02:00 UTC is 03:00 in Rome: the last reset was the day before
+	now = 1704852000
+	assert mod_store.last_reset_cutoff(settings, '00:00', 'UTC', now) == now - 86400 + 3600
+	assert mod_store.last_reset_cutoff({'persistent': True}, '00:00', 'UTC', now) is None